@@ -0,0 +1,228 @@
+#!/usr/bin/python
+
+import sys
+import time
+
+import numpy as np
+
+from objectfile import ObjectFile, isObjectFile
+from profiler import opcodeNames
+
+
+## Static analysis of assembled CPU230 programs with NumPy.
+##
+## The instructions of a .bin or .obj file are loaded into a uint32 array
+## and split into their fields with shifts and masks over the whole array,
+## the same 6/2/16 bit layout parseBits() reads one instruction at a time:
+##
+##   -  XXXXXX   -   XX   -   XXXXXXXXXXXXXXXX
+##      OpCode    Addr Mode       Operand
+##
+## On top of the decoded arrays it computes opcode and addressing mode
+## histograms, the jump targets, the basic blocks with the edges between
+## them, and the code that cannot be reached from the entry point.
+##
+## Jumps through a register or the memory (e.g. returns, JMP B) have no
+## static target. When a reachable block ends with one, every instruction
+## address used as an immediate operand (LOAD RET, ...) counts as reachable
+## as well. Self-modifying code is not followed.
+##
+## Needs NumPy, unlike the rest of the tools.
+##
+## usage: analysis.py <programfile> [<programfile> ...]
+
+
+JMP = 0x12
+FIRST_JUMP, LAST_JUMP = 0x12, 0x1A
+HALT = 0x01
+
+hexDigits = np.array([16 ** 5, 16 ** 4, 16 ** 3, 16 ** 2, 16, 1], dtype=np.uint32)
+
+
+# Load the instructions of a .bin or .obj file into a uint32 array.
+def loadInstructions(path):
+    if isObjectFile(path):
+        with ObjectFile(path) as program:
+            code = np.frombuffer(program.code, dtype=np.uint8).astype(np.uint32)
+        code = code.reshape(-1, 3)
+        return code[:, 0] << 16 | code[:, 1] << 8 | code[:, 2]
+    with open(path, 'rb') as f:
+        data = f.read()
+    # The assembler writes 6 hexadecimal digits and a newline per instruction,
+    # such files are converted without looking at every line.
+    if data and len(data) % 7 == 0:
+        lines = np.frombuffer(data, dtype=np.uint8).reshape(-1, 7)
+        if (lines[:, 6] == 10).all():
+            digits = lines[:, :6].astype(np.uint32)
+            isLetter = digits >= ord('A')
+            values = np.where(isLetter, (digits | 0x20) - (ord('a') - 10), digits - ord('0'))
+            if (values < 16).all():
+                return values @ hexDigits
+    lines = data.decode('ascii').split()
+    return np.array([int(line, 16) for line in lines], dtype=np.uint32)
+
+
+# Split the instructions into their fields.
+# Returns the opcode, mode and operand arrays.
+def decode(instructions):
+    opcodes = ((instructions >> 18) & 0x3F).astype(np.uint8)
+    modes = ((instructions >> 16) & 0x3).astype(np.uint8)
+    operands = (instructions & 0xFFFF).astype(np.uint16)
+    return opcodes, modes, operands
+
+
+# Basic blocks and the edges between them.
+# starts and ends are instruction indices (ends exclusive), edges is a pair
+# of block index arrays, jumps the same for the taken direct jumps only and
+# falls marks the blocks that fall through into the next one. indirect marks
+# the blocks ending with a jump whose target is not known statically.
+class ControlFlowGraph:
+    __slots__ = ('starts', 'ends', 'edges', 'jumps', 'falls', 'indirect', 'reachable')
+
+    def __init__(self, opcodes, modes, operands, entry=0):
+        count = len(opcodes)
+        index = np.arange(count)
+        isJump = (opcodes >= FIRST_JUMP) & (opcodes <= LAST_JUMP)
+        isDirect = isJump & (modes == 0)
+        targets = directTargets(operands, isDirect, count)
+
+        # Instructions whose address is used as an immediate (LOAD RET, ...),
+        # the possible targets of the indirect jumps.
+        immediate = operands[(modes == 0) & ~isJump].astype(np.int64)
+        addressTaken = immediate[(immediate % 3 == 0) & (immediate // 3 < count)] // 3
+
+        # Leaders: the entry, every jump target, every address taken and every
+        # instruction after a jump or HALT.
+        isLeader = np.zeros(count + 1, dtype=bool)
+        isLeader[entry // 3] = True
+        isLeader[targets[targets >= 0]] = True
+        isLeader[addressTaken] = True
+        isLeader[index[isJump | (opcodes == HALT)] + 1] = True
+        leaders = np.flatnonzero(isLeader[:count])
+        self.starts = leaders
+        self.ends = np.append(leaders[1:], count)
+
+        last = self.ends - 1
+        lastOpcode = opcodes[last]
+        blockIds = np.arange(len(leaders))
+        # Taken edges of direct jumps.
+        lastTargets = targets[last]
+        taken = lastTargets >= 0
+        takenTo = np.searchsorted(leaders, lastTargets[taken], side='right') - 1
+        # Fall-through edges: everything except JMP, HALT and the last block.
+        falls = (lastOpcode != JMP) & (lastOpcode != HALT) & (blockIds < len(leaders) - 1)
+        self.falls = falls
+        self.jumps = (blockIds[taken], takenTo)
+        self.edges = (np.concatenate([blockIds[taken], blockIds[falls]]),
+                      np.concatenate([takenTo, blockIds[falls] + 1]))
+        self.indirect = isJump[last] & (modes[last] != 0)
+
+        addressTaken = np.flatnonzero(np.bincount(np.searchsorted(leaders, addressTaken, side='right') - 1,
+                                                  minlength=len(leaders)))
+        self.reachable = self.findReachable(np.searchsorted(leaders, entry // 3, side='right') - 1,
+                                            addressTaken)
+
+    # Blocks reachable from the entry block.
+    # Blocks joined by fall-through edges form runs, and the reachable part of
+    # a run is always its tail: entering a run marks everything up to the part
+    # that is already reachable with one slice. Only the jumps are walked one
+    # by one, over plain lists.
+    def findReachable(self, entryBlock, addressTaken):
+        blocks = len(self.starts)
+        order = np.argsort(self.jumps[0], kind='stable')
+        sources = self.jumps[0][order]
+        destinations = self.jumps[1][order].tolist()
+        first = np.searchsorted(sources, np.arange(blocks + 1)).tolist()
+        breaks = np.flatnonzero(~self.falls)
+        runEnds = (breaks[np.searchsorted(breaks, np.arange(blocks))] + 1).tolist()
+        indirectBefore = np.concatenate([[0], np.cumsum(self.indirect)]).tolist()
+
+        reachable = bytearray(blocks)
+        # End of a run -> its first reachable block.
+        runStarts = {}
+        stack = [int(entryBlock)]
+        indirectSeen = False
+        while stack:
+            block = stack.pop()
+            if reachable[block]:
+                continue
+            end = runEnds[block]
+            stop = runStarts.get(end, end)
+            reachable[block:stop] = b'\x01' * (stop - block)
+            runStarts[end] = block
+            stack.extend(destinations[first[block]:first[stop]])
+            if not indirectSeen and indirectBefore[stop] > indirectBefore[block]:
+                indirectSeen = True
+                stack.extend(addressTaken.tolist())
+        return np.frombuffer(bytes(reachable), dtype=np.uint8).astype(bool)
+
+    # Unreachable code as (first address, end address) pairs.
+    def unreachableRanges(self):
+        ranges = []
+        for start, end in zip(self.starts[~self.reachable].tolist(), self.ends[~self.reachable].tolist()):
+            if ranges and ranges[-1][1] == start * 3:
+                ranges[-1][1] = end * 3
+            else:
+                ranges.append([start * 3, end * 3])
+        return [tuple(pair) for pair in ranges]
+
+
+# Instruction index every direct jump goes to, -1 for the other instructions
+# and for targets that are not the start of an instruction in the program.
+def directTargets(operands, isDirect, count):
+    addresses = operands.astype(np.int64)
+    valid = isDirect & (addresses % 3 == 0) & (addresses // 3 < count)
+    return np.where(valid, addresses // 3, -1)
+
+
+# Statistics of one program as a dict.
+def analyze(instructions, entry=0):
+    opcodes, modes, operands = decode(instructions)
+    isJump = (opcodes >= FIRST_JUMP) & (opcodes <= LAST_JUMP)
+    result = {
+        'instructions': len(instructions),
+        'opcodes': np.bincount(opcodes, minlength=64),
+        'modes': np.bincount(opcodes.astype(np.int64) * 4 + modes, minlength=256).reshape(64, 4),
+        'jumpTargets': np.flatnonzero(np.bincount(operands[isJump & (modes == 0)], minlength=0x10000)),
+        'indirectJumps': int((isJump & (modes != 0)).sum()),
+    }
+    if len(instructions):
+        graph = ControlFlowGraph(opcodes, modes, operands, entry)
+        result['blocks'] = len(graph.starts)
+        result['edges'] = len(graph.edges[0])
+        result['unreachable'] = graph.unreachableRanges()
+        result['graph'] = graph
+    else:
+        result['blocks'] = result['edges'] = 0
+        result['unreachable'] = []
+    return result
+
+
+def printReport(name, result):
+    print('%s: %d instructions, %d blocks, %d edges, %d jump targets, %d indirect jumps'
+          % (name, result['instructions'], result['blocks'], result['edges'],
+             len(result['jumpTargets']), result['indirectJumps']))
+    print('  %-10s %10s %8s %8s %8s %8s' % ('opcode', 'count', 'imm', 'reg', '[reg]', '[mem]'))
+    for opcode in np.flatnonzero(result['opcodes']).tolist():
+        modes = result['modes'][opcode]
+        print('  %-10s %10d %8d %8d %8d %8d' % (opcodeNames.get(opcode, '%02X' % opcode),
+                                                result['opcodes'][opcode], *modes.tolist()))
+    for start, end in result['unreachable']:
+        print('  unreachable: %04X-%04X (%d instructions)' % (start, end - 3, (end - start) // 3))
+
+
+def main(argv):
+    if len(argv) < 2: print('usage: analysis.py <programfile> [<programfile> ...]'); sys.exit(1)
+    total = 0
+    start = time.perf_counter()
+    for path in argv[1:]:
+        instructions = loadInstructions(path)
+        result = analyze(instructions)
+        printReport(path, result)
+        total = total + len(instructions)
+    elapsed = time.perf_counter() - start
+    print('%d instructions in %.3fs (%.0f instructions/sec)' % (total, elapsed, total / elapsed if elapsed else 0))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -1,7 +1,20 @@
 #!/usr/bin/python
 
+import os
 import sys  # read in <sourcefile> 2nd command parameter line by line
 
+from objectfile import Program
+from preprocessor import preprocessFile
+
+
+## Usable as a script or as a library:
+##
+##   program = assemble("LOAD 'A'\nPRINT A\nHALT")
+##   machine.load(program)
+##
+## assemble() works on a string or on any iterable of lines and returns a
+## Program with the packed code and the labels as its symbol table.
+
 
 # Save registers as a dictionary for accessing them easily
 registers = {
@@ -30,163 +43,305 @@ addressingModes = {
     'memory': '3',
 }
 
-# Some global variables..
-lines, output = [], []
-
-labels = {}
+# The same tables as integers, used while encoding.
+registerNumbers = {name: int(number, 16) for name, number in registers.items()}
+opCodeNumbers = {name: int(code, 16) for name, code in opCodes.items()}
+IMMEDIATE, REGISTER, REGMEM, MEMORY = (int(addressingModes[name]) for name in
+                                       ('immediate', 'register', 'regmem', 'memory'))
 
-start_address = 0
 
-if len(sys.argv) != 2: print('usage: assembler.py <sourcefile>'); sys.exit(1)
-f = open(sys.argv[1], 'r')
-while True:  # read in the source line
-    line = f.readline()
-    if not line: break
-    lines.append(line.strip())  # store each line without leading/trailing whitespaces
-f.close()
 
+# Read the source file one stripped line at a time.
+# The whole source is never kept in memory.
+def readLines(f):
+    for line in f:
+        yield line.strip()  # each line without leading/trailing whitespaces
 
 
-# - Check the operands and get their addressing mode names.
-# - From their addressing modes compute the operand bits as hex.
+# - Check the operands and get their addressing modes.
+# - From their addressing modes compute the operand value.
 # Args:
 #   operand (string)
 #
+#   labels (dict): label addresses known so far
+#
 # Returns:
-#   addressingMode (string): key of dict(addressingModes)
-#   convertedHex (string): hexcode of converted operand
-def convertOperand(operand):
-    addressingMode = 'nill'
-    convertedHex = ''
+#   addressingMode (int): value of dict(addressingModes)
+#   value (int): operand value, None when it is a label that is not defined yet
+def convertOperand(operand, labels):
     # Check for immediate chars
     if (operand.startswith("'")):
-        # Seperate it from their apostrophes and convert it to hexadecimal
-        addressingMode = addressingModes['immediate']
-        convertedHex = hex(ord(operand[1:-1]))[2:]
-    
+        # Seperate it from their apostrophes and take the character code
+        return IMMEDIATE, ord(operand[1:-1])
+
     # Check for memory related addreses
-    elif (operand.startswith("[")):
-        addressingMode = addressingModes['memory']
+    if (operand.startswith("[")):
         withoutBrackets = operand[1:-1]
         # They can refered with register. Check here.
-        if withoutBrackets in ['A', 'B', 'C', 'D', 'E']:
-            convertedHex = registers[withoutBrackets]
-            addressingMode = addressingModes['regmem']
-        else:
-            convertedHex = withoutBrackets
+        if withoutBrackets in registerNumbers:
+            return REGMEM, registerNumbers[withoutBrackets]
+        return MEMORY, int(withoutBrackets, 16)
     # Check here for register addressing modes.
-    elif (operand in ['A', 'B', 'C', 'D', 'E']):
-        addressingMode = addressingModes['register']
-        convertedHex = registers[operand]
+    if (operand in registerNumbers):
+        return REGISTER, registerNumbers[operand]
     # Check remaining immediate data.
-    elif (operand.isdigit()):
-        addressingMode = addressingModes['immediate']
-        convertedHex = operand
+    if (operand.isdigit()):
+        return IMMEDIATE, int(operand, 16)
     # Lastly they are labels.
-    else:
-        addressingMode = addressingModes['immediate']
-        convertedHex = labels[operand]
-    return addressingMode,convertedHex
+    return IMMEDIATE, labels.get(operand)
 
 
+# Pack the OPCODE - MODE - OPERAND fields into a 24-bit instruction.
+# -  XXXXXX   -   XX   -   XXXXXXXXXXXXXXXX
+#    OpCode    Addr Mode       Operand
+def encodeInstruction(opcode, mode, operand):
+    return (opcode << 18) | (mode << 16) | operand
 
-# Helper functions for converting integers to binary strings.
-
-def opCodeToBin(opcode):
-    numOfBits = 6
-    scale = 16
-    return bin(int(opcode, scale))[2:].zfill(numOfBits)
-
-def modeToBin(mode):
-    numOfBits = 2
-    scale = 16
-    return bin(int(mode, scale))[2:].zfill(numOfBits)
-
-def operandToBin(operand):
-    numOfBits = 16
-    scale = 16
-    return bin(int(operand, scale))[2:].zfill(numOfBits)
 
 
+################## PEEPHOLE OPTIMIZER #####################
+#
+# Optional pass over the stripped source lines before they are assembled.
+# Rewritten lines keep their place and removed lines become empty, so the
+# line numbers stay the same, and the labels get their new addresses when
+# the lines are assembled afterwards.
+#
+# - NOP is removed.
+# - LOAD X right after STORE X is removed, for a register or a memory operand.
+# - A jump to a label in front of a JMP jumps to the JMP's target instead.
+# - A jump to the instruction right after it is removed.
+#
+# Programs that refer to code addresses by number instead of by label
+# should not be optimized, removed instructions move the code after them.
 
+# Opcodes that jump to their operand.
+jumpNames = frozenset(name for name, code in opCodes.items() if 0x12 <= int(code, 16) <= 0x1A)
 
 
-################## PASS-1 #####################
-#
-# First pass for determining the labels and their addresses.
-#
-counter = 0
-for line in lines:
-    
-    # Split the lines for spaces and get the instructions.
-    instruction = line.split(" ")
-
-    # Instruction halt does not require an address we should skip it.
-    if instruction[0] == 'HALT':
-        continue
-    
-    # check the NOP instruction
-    if instruction[0] == 'NOP':
-        counter = counter + 1
-        continue
-    # Here we check the labels
-    if len(instruction) < 2:
-        # If we find the label drop the ':' seperator from it
-        # And add it to the labels dictionary.
-        labels[line[:-1]] = hex(counter*3)[2:]
-    counter = counter + 1
-
-
-################## PASS-2 #####################
+# Classify a stripped line the way assembleLines() reads it.
+# Returns None for an empty line, ('label', name) or ('op', name, operand).
+def parseLine(line):
+    instruction = line.split(None, 1)
+    if not instruction:
+        return None
+    if len(instruction) > 1:
+        return ('op', instruction[0], instruction[1].strip())
+    if instruction[0] == 'HALT' or instruction[0] == 'NOP':
+        return ('op', instruction[0], None)
+    return ('label', line[:-1])
+
+
+# Whether the operand is a label and not a number, a register or a character.
+def isLabelOperand(operand):
+    return not (operand.startswith("'") or operand.startswith('[') or
+                operand in registerNumbers or operand.isdigit())
+
+
+# Optimize the stripped source lines.
+# Returns the new lines, the number of rewrites of every kind is added to stats.
+# Every rule runs once over the lines, in an order where no rule creates
+# work for an earlier one.
+def optimizeLines(lines, stats):
+    lines = list(lines)
+    for kind in ('nop', 'store-load', 'jump-threaded', 'jump-next'):
+        stats.setdefault(kind, 0)
+
+    parsed = []
+    for index, line in enumerate(lines):
+        item = parseLine(line) if line else None
+        if item is None:
+            continue
+        if item[0] == 'op' and item[1] == 'NOP':
+            lines[index] = ''
+            stats['nop'] += 1
+            continue
+        parsed.append((index, item))
+
+    # STORE X, LOAD X, LOAD X: the STORE stays the one to compare with.
+    kept = []
+    for index, item in parsed:
+        if kept and item[0] == 'op' and item[1] == 'LOAD':
+            previous = kept[-1][1]
+            if (previous[0] == 'op' and previous[1] == 'STORE' and previous[2] == item[2] and
+                    (item[2] in registerNumbers or item[2].startswith('['))):
+                lines[index] = ''
+                stats['store-load'] += 1
+                continue
+        kept.append((index, item))
+    parsed = kept
+
+    # Label name -> the first instruction after it (None past the end).
+    # A label defined more than once means different addresses before
+    # and after its second definition, jumps to it are left alone.
+    targets = {}
+    repeated = set()
+    pending = []
+    for index, item in parsed:
+        if item[0] == 'label':
+            if item[1] in targets or item[1] in pending:
+                repeated.add(item[1])
+            pending.append(item[1])
+        else:
+            for name in pending:
+                targets[name] = item
+            pending = []
+    for name in pending:
+        targets[name] = None
+    for name in repeated:
+        del targets[name]
+
+    # Label name -> where a jump to it ends up after following the JMPs in
+    # front of it. A chain of JMPs that loops ends at the label where it
+    # meets itself again, all of its labels jump to the same loop.
+    final = {}
+    for name in targets:
+        chain = []
+        current = name
+        while current not in final:
+            chain.append(current)
+            target = targets[current]
+            if (target is None or target[1] != 'JMP' or not isLabelOperand(target[2]) or
+                    target[2] not in targets or target[2] in chain):
+                final[current] = current
+                break
+            current = target[2]
+        for label in chain:
+            final[label] = final[current]
+
+    # Backwards, so removing a jump puts the labels in front of it next to
+    # the ones after it for the jumps further up.
+    following = set()
+    for index, item in reversed(parsed):
+        if item[0] == 'label':
+            following.add(item[1])
+            continue
+        name, operand = item[1], item[2]
+        if name in jumpNames and isLabelOperand(operand) and operand in targets:
+            if operand not in following and final[operand] != operand:
+                operand = final[operand]
+                lines[index] = '%s %s' % (name, operand)
+                stats['jump-threaded'] += 1
+            if operand in following:
+                lines[index] = ''
+                stats['jump-next'] += 1
+                continue
+        following = set()
+    return lines
+
+
+################## SINGLE PASS #####################
 #
-# If we encounter with label we will use the labeled addresses for them.
+# Labels get the address of the instruction that follows them.
+# A label that is used before it is defined is emitted with operand 0 and
+# remembered in the fixup list, the operand is patched in once the whole
+# source has been read.
 #
-counter = 0
-for line in lines:
-    # Split the lines for spaces and get the instructions.
-    instruction = line.split(" ")
+# Returns the instructions as integers, the labels are added to the given dict.
+# When lineNumbers is a list, the source line number (from 1) of every
+# instruction is appended to it.
+def assembleLines(lines, labels, lineNumbers=None):
+    code = []
+    fixups = []
+    for lineNumber, line in enumerate(lines, 1):
+        # Split the line into the instruction and its operand.
+        instruction = line.split(None, 1)
+        if not instruction:
+            continue
 
-    # Check the opcodes with operand
-    if len(instruction) > 1:
-        # Get the opcode from its name
-        opcode = opCodes[instruction[0]]
-        # Get the operand and addressing mode as an hex.
-        addr, operand = convertOperand(instruction[1])
-    else:
-        # Check for 'HALT' instruction
-        if instruction[0] == 'HALT':
-            opcode = opCodes[instruction[0]]
-            # Manually gave the addressing mode and operand
-            addr, operand = '0','0000'
-        elif instruction[0] == 'NOP':
-            opcode = opCodes[instruction[0]]
-            addr, operand = '0','0000'
+        # Check the opcodes with operand
+        if len(instruction) > 1:
+            # Get the opcode from its name
+            opcode = opCodeNumbers[instruction[0]]
+            # Get the operand and addressing mode.
+            operandText = instruction[1].strip()
+            mode, operand = convertOperand(operandText, labels)
+            if operand is None:
+                fixups.append((len(code), operandText))
+                operand = 0
+        # HALT and NOP have no operand.
+        elif instruction[0] == 'HALT' or instruction[0] == 'NOP':
+            opcode = opCodeNumbers[instruction[0]]
+            mode, operand = IMMEDIATE, 0
         else:
-            # Check for label instruction
+            # If we find the label drop the ':' seperator from it
+            # And add it to the labels dictionary.
+            labels[line[:-1]] = len(code) * 3
             continue
-    
-    # Converting the hexadecimals to binary is more convenient.
-    # Because we concat two binary strings with different lengths.
-    resultBinary = opCodeToBin(opcode) + modeToBin(addr) + operandToBin(operand)
-    decimal = int(resultBinary, 2)
-    # Output list contains with filled zero hexadecimals.
-    output.append(str(hex(decimal)[2:]).zfill(6))
-    counter = counter + 1
-
-# Save the original file descriptor
-original_stdout = sys.stdout
-
-# Get the result filename from argument
-# And make the stdout(file descriptor) to this file
-outFile = open(sys.argv[1][:-4]+".bin", 'w')
-sys.stdout = outFile
-
-# After appending every line to the output file
-for element in output:
-    print(element.upper())
-
-# Change back to original File descriptor(Doesn't needed)
-sys.stdout = original_stdout
-outFile.close()
-
-# Exit()
\ No newline at end of file
+
+        code.append(encodeInstruction(opcode, mode, operand))
+        if lineNumbers is not None:
+            lineNumbers.append(lineNumber)
+
+    # Patch the forward references now that every label is known.
+    for index, label in fixups:
+        code[index] |= labels[label]
+    return code
+
+
+# Assemble CPU230 source into a Program.
+# source is either the whole text or an iterable of lines (e.g. an open file).
+# lineNumbers is filled as in assembleLines().
+# When optimizations is a dict the peephole optimizer runs first and
+# counts its rewrites into it (see optimizeLines).
+def assemble(source, lineNumbers=None, optimizations=None):
+    if isinstance(source, str):
+        source = source.splitlines()
+    lines = (line.strip() for line in source)
+    if optimizations is not None:
+        lines = optimizeLines(lines, optimizations)
+    labels = {}
+    instructions = assembleLines(lines, labels, lineNumbers)
+    code = b''.join(instruction.to_bytes(3, 'big') for instruction in instructions)
+    # Labels at or after the end of the code mark the data segment.
+    dataLabels = [address for address in labels.values() if address >= len(code)]
+    dataEnd = max(dataLabels) + 2 if dataLabels else len(code)
+    return Program(code, labels, dataStart=len(code), dataEnd=dataEnd)
+
+
+# Assemble a source file without reading it into memory at once.
+def assembleFile(path, lineNumbers=None, optimizations=None):
+    with open(path, 'r') as f:
+        return assemble(readLines(f), lineNumbers, optimizations)
+
+
+# Write the program as a text .bin file: one uppercase 6 digit hexadecimal
+# instruction per line.
+def writeText(program, path):
+    with open(path, 'w') as outFile:
+        outFile.writelines('%06X\n' % instruction for instruction in program.instructions())
+
+
+def main(argv):
+    # --binary writes a packed object file (<name>.obj) instead of the text .bin
+    binaryOutput = '--binary' in argv[1:]
+    # --optimize runs the peephole optimizer and reports what it saved
+    optimize = '--optimize' in argv[1:]
+    # --preprocess expands INCLUDE, MACRO and EQU first (see preprocessor.py),
+    # with the cache in .cpu230cache next to the source
+    preprocess = '--preprocess' in argv[1:]
+    arguments = [arg for arg in argv if arg not in ('--binary', '--optimize', '--preprocess')]
+
+    if len(arguments) != 2:
+        print('usage: assembler.py [--binary] [--optimize] [--preprocess] <sourcefile>'); sys.exit(1)
+    optimizations = {} if optimize else None
+    if preprocess:
+        cacheDirectory = os.path.join(os.path.dirname(os.path.abspath(arguments[1])), '.cpu230cache')
+        program = assemble(preprocessFile(arguments[1], cacheDirectory), optimizations=optimizations)
+    else:
+        program = assembleFile(arguments[1], optimizations=optimizations)
+    if optimize:
+        removed = optimizations['nop'] + optimizations['store-load'] + optimizations['jump-next']
+        print('peephole: %d instructions removed (%d left), %d jumps threaded' %
+              (removed, len(program.code) // 3, optimizations['jump-threaded']))
+        # Every removed instruction and every threaded jump saves one
+        # instruction each time that code runs.
+        print('estimated cycles saved per pass over the rewritten code: %d'
+              % (removed + optimizations['jump-threaded']))
+    if binaryOutput:
+        program.writeObject(arguments[1][:-4] + ".obj")
+    else:
+        writeText(program, arguments[1][:-4] + ".bin")
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,135 @@
+#!/usr/bin/python
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from assembler import assembleFile
+from devices import InputStream, OutputCapture
+from executer import Machine
+from watchdog import runGuarded
+
+
+## Runs many CPU230 programs in parallel and reports one JSON line per program.
+##
+## usage: batch.py [-j N] [--max-steps N] [--max-cycles N] [--timeout S] [--jit] <directory|manifest>
+##
+## - A directory runs every .asm, .bin and .obj file in it. The input for READ
+##   is taken from a file with the same name and the .in extension, if any.
+## - A manifest has one program per line: either a path or a JSON object like
+##   {"path": "x.bin", "input": "ab", "max_steps": 1000, "max_cycles": 5000, "timeout": 2.5}
+##   Relative paths are relative to the manifest.
+##
+## Every program gets its own machine in one of the worker processes, READ
+## reads from the scripted input and PRINT output is captured. The budgets
+## are enforced by watchdog.py, one cycle per instruction. The result line
+## holds the status ("halted", "max_steps", "max_cycles", "timeout" or
+## "fault"), the executed steps and cycles, the output and the final registers.
+
+
+programExtensions = ('.asm', '.bin', '.obj')
+
+
+# Collect the jobs (dicts with at least a 'path') from a directory or a manifest.
+def readJobs(target):
+    jobs = []
+    if os.path.isdir(target):
+        for name in sorted(os.listdir(target)):
+            if not name.endswith(programExtensions):
+                continue
+            job = {'path': os.path.join(target, name)}
+            inputPath = os.path.join(target, os.path.splitext(name)[0] + '.in')
+            if os.path.exists(inputPath):
+                with open(inputPath, 'r') as f:
+                    job['input'] = f.read()
+            jobs.append(job)
+        return jobs
+    base = os.path.dirname(os.path.abspath(target))
+    with open(target, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            job = json.loads(line) if line.startswith('{') else {'path': line}
+            job['path'] = os.path.join(base, job['path'])
+            jobs.append(job)
+    return jobs
+
+
+# Load the program of a job: source files are assembled first.
+def loadJob(machine, path):
+    if path.endswith('.asm'):
+        machine.load(assembleFile(path))
+    else:
+        machine.loadFile(path)
+
+
+# Run one job in a worker process and return its result dict.
+# READ reads the scripted input and PRINT writes into an in-memory capture.
+def runJob(job):
+    options = job.get('options', {})
+    maxSteps = job.get('max_steps', options.get('max_steps'))
+    maxCycles = job.get('max_cycles', options.get('max_cycles'))
+    timeout = job.get('timeout', options.get('timeout'))
+    result = {'path': job['path']}
+    output = OutputCapture()
+    machine = Machine(InputStream(job.get('input', '')), output)
+    start = time.perf_counter()
+    cycles = 0
+    try:
+        loadJob(machine, job['path'])
+        report = runGuarded(machine, maxSteps, maxCycles, timeout, useBlocks=bool(options.get('jit')))
+        result['status'] = report.status
+        cycles = report.cycles
+        if report.error is not None:
+            result['error'] = report.error
+    except Exception as error:
+        result['status'] = 'fault'
+        result['error'] = '%s: %s' % (type(error).__name__, error)
+    result['seconds'] = round(time.perf_counter() - start, 6)
+    result['steps'] = machine.steps
+    result['cycles'] = cycles
+    result['output'] = output.getvalue().decode('utf-8', 'replace')
+    result['registers'] = dict(zip('ABCDE', machine.registers[1:]))
+    return result
+
+
+# Run all jobs on a process pool and yield the results in the order of the jobs.
+def runBatch(jobs, processes=None, **options):
+    for job in jobs:
+        job['options'] = options
+    # A few chunks per worker keeps the workers busy without much IPC per job.
+    chunksize = max(1, len(jobs) // (4 * (processes or os.cpu_count() or 1)))
+    with multiprocessing.Pool(processes) as pool:
+        for result in pool.imap(runJob, jobs, chunksize):
+            yield result
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='batch.py', description='Run many CPU230 programs in parallel.')
+    parser.add_argument('target', help='directory of programs or a manifest file')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='worker processes (default: CPU count)')
+    parser.add_argument('--max-steps', type=int, default=None, help='instruction budget per program')
+    parser.add_argument('--max-cycles', type=int, default=None, help='cycle budget per program')
+    parser.add_argument('--timeout', type=float, default=None, help='wall time budget per program in seconds')
+    parser.add_argument('--jit', action='store_true', help='run the programs with the block compiler')
+    parser.add_argument('-o', '--output', default=None, help='write the JSON lines here instead of stdout')
+    arguments = parser.parse_args(argv[1:])
+
+    jobs = readJobs(arguments.target)
+    out = open(arguments.output, 'w') if arguments.output else sys.stdout
+    try:
+        for result in runBatch(jobs, arguments.jobs, jit=arguments.jit,
+                               max_steps=arguments.max_steps, max_cycles=arguments.max_cycles,
+                               timeout=arguments.timeout):
+            out.write(json.dumps(result) + '\n')
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
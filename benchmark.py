@@ -0,0 +1,23 @@
+#!/usr/bin/python
+
+import sys
+
+import benchsuite
+
+
+## Quick measurement of the executer: runs the benchmark suite (see
+## benchsuite.py) and prints the results. The workloads are the .asm files
+## in benchmarks/.
+##
+## usage: benchmark.py [--repeat N] [-o results.json] [--compare old.json]
+##                     [workload ...]
+##
+## e.g. benchmark.py loop fib deep measures only those workloads.
+
+
+def main(argv):
+    benchsuite.main(argv)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
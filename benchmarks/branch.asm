@@ -0,0 +1,32 @@
+    LOAD 20
+    STORE E
+OUTER:
+    LOAD 1000
+    STORE D
+TEST:
+    LOAD D
+    AND 3
+    JZ ZERO
+    CMP 1
+    JE ONE
+    CMP 2
+    JNE THREE
+    DEC C
+    JMP NEXT
+ZERO:
+    INC B
+    JMP NEXT
+ONE:
+    LOAD C
+    ADD 9999
+    JC NEXT
+    INC B
+    JMP NEXT
+THREE:
+    INC C
+NEXT:
+    DEC D
+    JNZ TEST
+    DEC E
+    JNZ OUTER
+    HALT
@@ -0,0 +1,33 @@
+    LOAD SOURCE
+    STORE B
+    LOAD 800
+    STORE D
+FILL:
+    LOAD D
+    STORE [B]
+    INC B
+    INC B
+    DEC D
+    JNZ FILL
+    LOAD 40
+    STORE E
+REPEAT:
+    LOAD SOURCE
+    STORE B
+    ADD 1000
+    STORE C
+    LOAD 800
+    STORE D
+COPY:
+    LOAD [B]
+    STORE [C]
+    INC B
+    INC B
+    INC C
+    INC C
+    DEC D
+    JNZ COPY
+    DEC E
+    JNZ REPEAT
+    HALT
+SOURCE:
@@ -0,0 +1,12 @@
+    LOAD 80
+    STORE E
+OUTER:
+    LOAD 1000
+    STORE D
+INNER:
+    DEC D
+    NOP
+    JNZ INNER
+    DEC E
+    JNZ OUTER
+    HALT
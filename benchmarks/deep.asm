@@ -0,0 +1,22 @@
+    LOAD 3000
+    STORE D
+    LOAD DONE
+    PUSH A
+    JMP SUM
+DONE:
+    HALT
+SUM:
+    LOAD D
+    CMP 0
+    JZ RETURN
+    PUSH D
+    DEC D
+    LOAD NEXT
+    PUSH A
+    JMP SUM
+NEXT:
+    POP B
+    ADD B
+RETURN:
+    POP B
+    JMP B
@@ -0,0 +1,31 @@
+    LOAD 16
+    STORE D
+    LOAD DONE
+    PUSH A
+    JMP FIB
+DONE:
+    HALT
+FIB:
+    LOAD D
+    CMP 0
+    JZ RETURN
+    CMP 1
+    JZ RETURN
+    DEC D
+    PUSH D
+    LOAD RET1
+    PUSH A
+    JMP FIB
+RET1:
+    POP D
+    PUSH A
+    DEC D
+    LOAD RET2
+    PUSH A
+    JMP FIB
+RET2:
+    POP B
+    ADD B
+RETURN:
+    POP B
+    JMP B
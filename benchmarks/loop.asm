@@ -0,0 +1,15 @@
+    LOAD 'A'
+    STORE C
+    LOAD MYDATA
+    STORE B
+    LOAD 9999
+    STORE D
+LOOP1:
+    LOAD C
+    STORE [B]
+    INC C
+    DEC D
+    NOP
+    JNZ LOOP1
+    HALT
+MYDATA:
@@ -0,0 +1,12 @@
+    LOAD 4
+    STORE E
+OUTER:
+    LOAD 0
+    STORE D
+INNER:
+    PRINT 'A'
+    DEC D
+    JNZ INNER
+    DEC E
+    JNZ OUTER
+    HALT
@@ -0,0 +1,266 @@
+#!/usr/bin/python
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import jit
+from assembler import assemble, assembleFile
+from devices import OutputBuffer
+from executer import MEMORY_SIZE, Machine
+from objectfile import writeObject
+
+
+## Benchmark suite: runs the workloads in benchmarks/ and reports the results
+## as JSON, so runs on different commits can be compared.
+##
+##   loop.asm       the LOOP1 loop of program.asm without the PRINT
+##   countdown.asm  nested DEC / NOP / JNZ loops, which the jit fast-forwards
+##   copy.asm       fills a block of words and copies it through [B] and [C]
+##   fib.asm        recursive Fibonacci, PUSH / POP on every call
+##   deep.asm       a recursive sum whose calls fill most of the stack
+##   print.asm      4 * 65536 PRINTs into /dev/null
+##   branch.asm     CMP / AND with many taken and not taken jumps
+##
+## Calls push the return address and return with JMP to the popped address.
+##
+## Every workload runs with every tier (the interpreter and the jit) in a
+## fresh process and reports instructions/sec and the peak RSS of that
+## process. The assembler is measured with a generated source of
+## ASSEMBLER_LINES lines (lines/sec and peak RSS). Loading is measured with
+## the largest program that fits in the memory, as a text .bin file and as
+## an object file. The startup time is the wall time of executer.py running
+## a program that only halts.
+##
+## usage: benchsuite.py [--repeat N] [-o results.json] [--compare old.json]
+##                      [workload ...]
+##
+## Named workloads (e.g. loop fib) run alone, without the assembler, load
+## and startup measurements.
+##
+## With --compare the instructions/sec and lines/sec are printed next to the
+## ones in the older results file.
+
+
+BENCHMARK_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks')
+ASSEMBLER_LINES = 100000
+STARTUP_RUNS = 5
+LOAD_RUNS = 20
+
+tiers = {
+    'interpreter': Machine.run,
+    'jit': jit.run,
+}
+
+
+# Peak resident set size of this process in kilobytes.
+def peakRss():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return usage // 1024 if sys.platform == 'darwin' else usage
+
+
+# A large source for the assembler: blocks of arithmetic, memory accesses
+# and jumps back and forth between labels.
+def generateSource(lineCount):
+    lines = []
+    block = 0
+    while len(lines) < lineCount:
+        lines.extend((
+            'BLOCK%d:' % block,
+            '    LOAD %d' % (block % 10000),
+            '    ADD [B]',
+            '    STORE [%04X]' % (0x8000 + 2 * (block % 0x1000)),
+            '    CMP C',
+            '    JNZ BLOCK%d' % max(0, block - 1),
+            '    INC D',
+            '    JZ BLOCK%d' % (block + 1),
+        ))
+        block = block + 1
+    lines.append('BLOCK%d:' % block)
+    lines.append('    HALT')
+    return '\n'.join(lines) + '\n'
+
+
+# Run one workload with one tier, best of repeat runs. Runs in a fresh process.
+def measureWorkload(path, tierName, repeat):
+    program = assembleFile(path)
+    run = tiers[tierName]
+    best = None
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(repeat):
+            machine = Machine(outputDevice=OutputBuffer(devnull))
+            machine.load(program)
+            start = time.perf_counter()
+            run(machine)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+    return {
+        'instructions': machine.steps,
+        'seconds': round(best, 6),
+        'instructions_per_sec': round(machine.steps / best),
+        'peak_rss_kb': peakRss(),
+    }
+
+
+# Assemble the generated source, best of repeat runs. Runs in a fresh process.
+def measureAssembler(lineCount, repeat):
+    source = generateSource(lineCount)
+    lines = source.count('\n')
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        assemble(source)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return {
+        'lines': lines,
+        'seconds': round(best, 6),
+        'lines_per_sec': round(lines / best),
+        'peak_rss_kb': peakRss(),
+    }
+
+
+# Seconds per load of the largest program that fits in the memory into one
+# machine, as a text .bin file and as an object file, best of repeat runs of
+# LOAD_RUNS loads. Runs in a fresh process.
+def measureLoad(repeat):
+    count = MEMORY_SIZE // 3
+    instructions = [(0x06 << 18) | (1 << 16) | (index % 5 + 1) for index in range(count)]
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        textPath = os.path.join(directory, 'large.bin')
+        with open(textPath, 'w') as f:
+            f.writelines('%06X\n' % instruction for instruction in instructions)
+        objectPath = os.path.join(directory, 'large.obj')
+        writeObject(objectPath, b''.join(instruction.to_bytes(3, 'big') for instruction in instructions))
+        machine = Machine()
+        for name, path in (('text', textPath), ('object', objectPath)):
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                for _ in range(LOAD_RUNS):
+                    machine.reset()
+                    machine.loadFile(path)
+                elapsed = (time.perf_counter() - start) / LOAD_RUNS
+                best = elapsed if best is None else min(best, elapsed)
+            results[name] = {'instructions': count, 'seconds': round(best, 6)}
+    return results
+
+
+# Wall time of executer.py loading and running a program that only halts.
+def measureStartup(runs=STARTUP_RUNS):
+    executer = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'executer.py')
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'halt.bin')
+        with open(path, 'w') as f:
+            f.write('040000\n')
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, executer, path], check=True, stdout=subprocess.DEVNULL)
+            times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'pass'], check=True)
+        python = time.perf_counter() - start
+    return {'seconds': round(min(times), 6), 'python_seconds': round(python, 6)}
+
+
+# Short hash of the checked out commit, None outside of a git work tree.
+def currentCommit():
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+
+# Run the named workloads, all of them and the other measurements when
+# names is empty.
+def runSuite(repeat, names=()):
+    workloads = sorted(name[:-4] for name in os.listdir(BENCHMARK_DIRECTORY) if name.endswith('.asm'))
+    for name in names:
+        if name not in workloads:
+            raise ValueError('unknown workload %r (known: %s)' % (name, ', '.join(workloads)))
+    results = {
+        'commit': currentCommit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'workloads': {},
+    }
+    # Every measurement gets a fresh interpreter, so the peak RSS is its own.
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1, maxtasksperchild=1) as pool:
+        for workload in (names or workloads):
+            path = os.path.join(BENCHMARK_DIRECTORY, workload + '.asm')
+            results['workloads'][workload] = {
+                tierName: pool.apply(measureWorkload, (path, tierName, repeat)) for tierName in tiers}
+        if names:
+            return results
+        results['assembler'] = pool.apply(measureAssembler, (ASSEMBLER_LINES, repeat))
+        results['load'] = pool.apply(measureLoad, (repeat,))
+    results['startup'] = measureStartup()
+    return results
+
+
+def printResults(results, previous=None):
+    def change(new, old):
+        return '  (%+.1f%% vs %s)' % ((new / old - 1) * 100, previous.get('commit')) if old else ''
+
+    for workload, byTier in results['workloads'].items():
+        for tierName, result in byTier.items():
+            old = None
+            if previous is not None:
+                old = previous.get('workloads', {}).get(workload, {}).get(tierName, {}).get('instructions_per_sec')
+            print('%-9s [%s]: %d instructions, %.0f instructions/sec, peak RSS %d KB%s' % (
+                workload, tierName, result['instructions'], result['instructions_per_sec'],
+                result['peak_rss_kb'], change(result['instructions_per_sec'], old)))
+    if 'assembler' not in results:
+        return
+    assembler = results['assembler']
+    old = previous.get('assembler', {}).get('lines_per_sec') if previous is not None else None
+    print('assembler: %d lines, %.0f lines/sec, peak RSS %d KB%s' % (
+        assembler['lines'], assembler['lines_per_sec'], assembler['peak_rss_kb'],
+        change(assembler['lines_per_sec'], old)))
+    for name, load in results['load'].items():
+        old = previous.get('load', {}).get(name, {}).get('seconds') if previous is not None else None
+        print('load [%s]: %d instructions in %.2fms%s' % (name, load['instructions'], load['seconds'] * 1000,
+                                                        change(load['seconds'], old)))
+    print('startup: %.1fms (python alone %.1fms)' % (results['startup']['seconds'] * 1000,
+                                                    results['startup']['python_seconds'] * 1000))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='benchsuite.py', description='Run the CPU230 benchmark workloads.')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per measurement, the best one counts')
+    parser.add_argument('-o', '--output', default=None, help='write the results as JSON to this file')
+    parser.add_argument('--compare', default=None, help='results file of an earlier run to compare with')
+    parser.add_argument('workloads', nargs='*', help='only run these workloads (e.g. loop fib)')
+    arguments = parser.parse_args(argv[1:])
+
+    previous = None
+    if arguments.compare:
+        with open(arguments.compare, 'r') as f:
+            previous = json.load(f)
+    try:
+        results = runSuite(arguments.repeat, arguments.workloads)
+    except ValueError as error:
+        parser.error(str(error))
+    printResults(results, previous)
+    if arguments.output:
+        with open(arguments.output, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv)
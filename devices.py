@@ -0,0 +1,131 @@
+#!/usr/bin/python
+
+import io
+import sys
+
+
+## I/O devices of the machine: PRINT writes to an output device and READ
+## reads from an input device.
+##
+## - OutputBuffer collects the printed characters as bytes and writes them
+##   out in one go when the machine halts, when READ has to wait for input or
+##   when the buffer reaches its threshold.
+## - InputStream reads the input in large chunks from a file, a pipe or an
+##   in-memory buffer and hands it to READ one byte at a time.
+##
+## Without a stream both use sys.stdout / sys.stdin as they are when the
+## data is actually written or read, so redirecting them keeps working.
+
+
+# Write the buffered bytes to a binary stream or to a text stream.
+def writeBytes(stream, data):
+    if isinstance(stream, io.TextIOBase):
+        buffer = getattr(stream, 'buffer', None)
+        if buffer is None:
+            stream.write(data.decode('utf-8', 'replace'))
+            return
+        stream.flush()
+        stream = buffer
+    stream.write(data)
+    # Asyncio stream writers have no flush(), their transport sends the data.
+    if hasattr(stream, 'flush'):
+        stream.flush()
+
+
+# Buffered output device.
+# Every character is followed by the separator, the default b'\n' gives the
+# same output as printing each character on its own line.
+class OutputBuffer:
+    __slots__ = ('stream', 'buffer', 'threshold', 'separator')
+
+    def __init__(self, stream=None, threshold=1 << 16, separator=b'\n'):
+        self.stream = stream
+        self.buffer = bytearray()
+        self.threshold = threshold
+        self.separator = separator
+
+    def write(self, code):
+        buffer = self.buffer
+        if code < 0x80:
+            buffer.append(code)
+        else:
+            buffer += chr(code).encode('utf-8', 'surrogatepass')
+        buffer += self.separator
+        if len(buffer) >= self.threshold:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            writeBytes(sys.stdout if self.stream is None else self.stream, bytes(self.buffer))
+            self.buffer.clear()
+
+
+# Output device that keeps everything in memory, e.g. to compare outputs.
+class OutputCapture(OutputBuffer):
+    __slots__ = ('captured',)
+
+    def __init__(self, separator=b'\n'):
+        OutputBuffer.__init__(self, None, float('inf'), separator)
+        self.captured = self.buffer
+
+    def flush(self):
+        return
+
+    def getvalue(self):
+        return bytes(self.captured)
+
+
+# Prefetching input device.
+# source is bytes or str for in-memory input, or a readable file object.
+# READ used to take one character per input line, so line breaks are
+# skipped unless skipNewlines is False.
+class InputStream:
+    __slots__ = ('source', 'buffer', 'position', 'chunkSize', 'skipNewlines', 'eof')
+
+    def __init__(self, source=None, skipNewlines=True, chunkSize=1 << 16):
+        self.buffer = b''
+        self.position = 0
+        self.chunkSize = chunkSize
+        self.skipNewlines = skipNewlines
+        self.eof = False
+        if isinstance(source, str):
+            source = source.encode('utf-8')
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            self.buffer = bytes(source)
+            self.eof = True
+            source = None
+        self.source = source
+
+    # Whether a byte can be read without waiting for the source.
+    def available(self):
+        return self.position < len(self.buffer)
+
+    # Read the next chunk from the source. Returns False at the end of the input.
+    def refill(self):
+        if self.eof:
+            return False
+        source = sys.stdin if self.source is None else self.source
+        if isinstance(source, io.TextIOBase):
+            source = getattr(source, 'buffer', source)
+        if hasattr(source, 'read1'):
+            data = source.read1(self.chunkSize)
+        else:
+            data = source.read(self.chunkSize)
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if not data:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.position:] + data
+        self.position = 0
+        return True
+
+    # Return the next input byte. Raises EOFError at the end of the input.
+    def read(self):
+        while True:
+            if self.position >= len(self.buffer) and not self.refill():
+                raise EOFError('no more input for READ')
+            code = self.buffer[self.position]
+            self.position = self.position + 1
+            if not (self.skipNewlines and (code == 10 or code == 13)):
+                return code
@@ -1,50 +1,31 @@
+import struct
 import sys  # read in <sourcefile> 2nd command parameter line by line
 
+from devices import InputStream, OutputBuffer
+from objectfile import ObjectFile, Program, isObjectFile
+
 
 ## Each line consist of hexadecimal bytecodes
 ## - Converting them to the binary representations
 ## -  XXXXXX   -   XX   -   XXXXXXXXXXXXXXXX
 ##    OpCode    Addr Mode       Operand
-## 
+##
 ## - Each opcode has an own function.
 
 
 
 ## All the computations are done in decimal integers.
-## Then convert to the hexadecimal representations.
-
-
-########### GLOBAL VARIABLES ###########
+## Registers hold integers and the memory is a flat array of bytes,
+## hexadecimal strings are only used while reading the program.
 
-lines, output = [], []
 
-# Program Counter will shows the current instruction.
-program_counter = '0000'
+########### CONSTANTS ###########
 
 # Signed and unsigned max and min decimal integers for 2-byte
 unsignedMAX = 65535
 signedMAX = 32767
 signedMIN = -32768
 
-# Condition codes
-zf, cf, sf = 0, 0, 0
-
-# Registers [A,B,C,D,E] -> for simplicity used 1,2,3,4,5
-registers = {
-    '1': 0,
-    '2': 0,
-    '3': 0,
-    '4': 0,
-    '5': 0
-}
-
-# Stack pointer represents the maximum address of the memory
-# When something pushed to the stack it will grow the opposite way of the addresses.
-stack_pointer = 65535
-
-# 2-Byte words in stack saved in this list.
-stack = []
-
 # Memory is the main variable which stores:
 # - Instructions
 # - Data
@@ -69,7 +50,15 @@ stack = []
 #  .   -     .
 # FFFD - [STACK-TOP]
 # FFFF - [STACK-BOTTOM]
-memory = {}
+#
+# The stack pointer starts at the bottom (FFFF) and points to the last pushed
+# word. It may not grow below the end of the program and its data segment.
+#
+# Words and instructions are stored big-endian (most significant byte first).
+# Two extra bytes after FFFF let a word or an instruction that starts
+# at the very end of the memory be read without wrapping around.
+MEMORY_SIZE = 0x10000
+STACK_BOTTOM = 0xFFFF
 
 # ------------------------------------ #
 
@@ -113,510 +102,724 @@ def decimalToHex(decimal):
 def hexToDecimal(hexa):
     return int(hexa, 16)
 
+# Split a hexadecimal instruction into integer OPCODE - MODE - OPERAND fields.
+# Same 6/2/16 bit layout as parseBits() without the string round-trip.
+def decodeInstruction(num):
+    word = int(num, 16)
+    return word >> 18, (word >> 16) & 0x3, word & 0xFFFF
+
 # ------------------------------------ #
 
 
 
 #######----- OPCODES -----#######
 
-# The values of the registers and the memory should be hexadecimal (uppercased)
-# Also they are string and with filled up to 2 bytes! (Word size)
-# Example: 
-# registers['1'] = '000A'
-# memory['address'] = '002A' for data.
-# memory['address'] = 'ABCDEF' for instructions.
+# The values of the registers and the memory words are unsigned integers
+# that fit in 2 bytes (Word size).
+# Example:
+# machine.registers[1] = 10
+# machine.readWord(address) = 42 for data.
+# machine.memory[address:address + 3] = b'\xAB\xCD\xEF' for instructions.
+#
+# Every handler gets the machine it runs on as its first argument.
+#
+# Condition codes are not computed by the handlers. They only record the
+# unadjusted result (tempA) of the operation:
+# - machine.flag_result by every opcode that sets ZF and SF,
+# - machine.carry_result by the opcodes that also set CF.
+# The flags are derived from these when they are read (see Machine.zf).
+#
+# The registers are 1 to 5. A register operand above 5 fails on the list
+# index, register 0 is checked for: index 0 of machine.registers is not a
+# register and must not hold anything.
+
+# The error of an instruction that uses register 0.
+def noRegister():
+    return IndexError('list index out of range')
 
 # Loads operand onto A.
 # No Condition codes setup needed.
-def load(mode, operand):
-    #print("Mode: ", mode, "\t Operand: ", decimalToHex(operand))
-    global registers, memory
+def load(machine, mode, operand):
+    if operand == 0 and (mode == 1 or mode == 2):
+        raise noRegister()
     if mode == 0:
-        registers['1'] = decimalToHex(operand)
+        machine.registers[1] = operand
     elif mode == 1:
-        registers['1'] = registers[str(operand)]
+        machine.registers[1] = machine.registers[operand]
     elif mode == 2:
-        registers['1'] = memory[registers[str(operand)]]
+        machine.registers[1] = machine.readWord(machine.registers[operand])
     else:
-        registers['1'] = memory[decimalToHex(operand)]
+        machine.registers[1] = machine.readWord(operand)
 
 
 
 # Stores value in A to the operand.
 # No Condition codes setup needed.
-def store(mode, operand):
-    #print("Mode: ", mode, "\t Operand: ", decimalToHex(operand))
-    global registers, memory
+def store(machine, mode, operand):
+    if operand == 0 and (mode == 1 or mode == 2):
+        raise noRegister()
     if mode == 1:
-        registers[str(operand)] = registers['1']
+        machine.registers[operand] = machine.registers[1]
     elif mode == 2:
-        memory[registers[str(operand)]] = registers['1']
+        machine.writeWord(machine.registers[operand], machine.registers[1])
     else:
-        memory[decimalToHex(operand)] = registers['1']
+        machine.writeWord(operand, machine.registers[1])
 
 
 
 # Adds operand to A. Perform the addition by treating all the bits as unsigned integer.
 # CC set => CF, SF, ZF
-def add(mode, operand):
-    #print("Mode: ", mode, "\t Operand: ", decimalToHex(operand))
-    global registers, memory, zf, cf, sf
-    tempA = hexToDecimal(registers['1'])
+def add(machine, mode, operand):
+    if operand == 0 and (mode == 1 or mode == 2):
+        raise noRegister()
+    tempA = machine.registers[1]
     if mode == 0:
         tempA = tempA + operand
     elif mode == 1:
-        tempA = tempA + hexToDecimal(registers[str(operand)])
+        tempA = tempA + machine.registers[operand]
     elif mode == 2:
-        tempA = tempA + hexToDecimal(memory[registers[str(operand)]])
+        tempA = tempA + machine.readWord(machine.registers[operand])
     else:
-        tempA = tempA + hexToDecimal(memory[decimalToHex(operand)])
+        tempA = tempA + machine.readWord(operand)
+    machine.flag_result = machine.carry_result = tempA
     if tempA > unsignedMAX:
         tempA = tempA - unsignedMAX
-        cf = 1
-    else:
-        cf = 0
-    if tempA == 0:
-        zf = 1
-    else:
-        zf = 0
-    if utos(tempA) < 0:
-        sf = 1
-    else:
-        sf = 0
-    registers['1'] = decimalToHex(tempA)
-    
+    machine.registers[1] = tempA & 0xFFFF
+
 
 # Subtracts operand (OPR) from A.
 # CC set => CF, SF, ZF
-def sub(mode, operand):
-    #print("Mode: ", mode, "\t Operand: ", decimalToHex(operand))
-    global registers, memory, zf, cf, sf
-    tempA = hexToDecimal(registers['1'])
+def sub(machine, mode, operand):
+    if operand == 0 and (mode == 1 or mode == 2):
+        raise noRegister()
+    tempA = machine.registers[1]
     if mode == 0:
         tempA = tempA + ~(operand) + 1
     elif mode == 1:
-        tempA = tempA + ~(hexToDecimal(registers[str(operand)])) + 1
+        tempA = tempA + ~(machine.registers[operand]) + 1
     elif mode == 2:
-        tempA = tempA + ~(hexToDecimal(memory[registers[str(operand)]])) + 1
+        tempA = tempA + ~(machine.readWord(machine.registers[operand])) + 1
     else:
-        tempA = tempA + ~(hexToDecimal(memory[decimalToHex(operand)])) + 1
+        tempA = tempA + ~(machine.readWord(operand)) + 1
+    machine.flag_result = machine.carry_result = tempA
     if tempA > unsignedMAX:
         tempA = tempA - unsignedMAX
-        cf = 1
-    else:
-        cf = 0
-    if tempA == 0:
-        zf = 1
-    else:
-        zf = 0
-    if utos(tempA) < 0:
-        sf = 1
-    else:
-        sf = 0
-    registers['1'] = decimalToHex(tempA)
+    machine.registers[1] = tempA & 0xFFFF
 
 
 # increments operand (equivalent to add 1)
 # CC set => CF, SF, ZF
-def inc(mode, operand):
-    #print("Mode: ", mode, "\t Operand: ", decimalToHex(operand))
-    global registers, memory, zf, cf, sf
+def inc(machine, mode, operand):
+    if operand == 0 and (mode == 1 or mode == 2):
+        raise noRegister()
     tempA = 0
     if mode == 0:
         tempA = operand + 1
         operand = tempA
     elif mode == 1:
-        tempA = hexToDecimal(registers[str(operand)]) + 1
-        registers[str(operand)] = decimalToHex(tempA)
+        tempA = machine.registers[operand] + 1
+        machine.registers[operand] = tempA & 0xFFFF
     elif mode == 2:
-        tempA = hexToDecimal(memory[registers[str(operand)]]) + 1
-        memory[registers[str(operand)]] = decimalToHex(tempA)
-    else:
-        tempA = hexToDecimal(memory[decimalToHex(operand)]) + 1
-        memory[decimalToHex(operand)] = decimalToHex(tempA)
-    if tempA > unsignedMAX:
-        tempA = tempA - unsignedMAX
-        cf = 1
+        tempA = machine.readWord(machine.registers[operand]) + 1
+        machine.writeWord(machine.registers[operand], tempA)
     else:
-        cf = 0
-    if tempA == 0:
-        zf = 1
-    else:
-        zf = 0
-    if utos(tempA) < 0:
-        sf = 1
-    else:
-        sf = 0
+        tempA = machine.readWord(operand) + 1
+        machine.writeWord(operand, tempA)
+    machine.flag_result = machine.carry_result = tempA
 
 
 # decrements operand (equivalent to subtract 1)
 # CC set => CF, SF, ZF
-def dec(mode, operand):
-    #print("Mode: ", mode, "\t Operand: ", decimalToHex(operand))
-    global registers, memory, zf, cf, sf
+def dec(machine, mode, operand):
+    if operand == 0 and (mode == 1 or mode == 2):
+        raise noRegister()
     tempA = 0
     if mode == 0:
         tempA = operand + (~1) + 1
         operand = tempA
     elif mode == 1:
-        tempA = hexToDecimal(registers[str(operand)]) + (~1) + 1
-        registers[str(operand)] = decimalToHex(tempA)
+        tempA = machine.registers[operand] + (~1) + 1
+        machine.registers[operand] = tempA & 0xFFFF
     elif mode == 2:
-        tempA = hexToDecimal(memory[registers[str(operand)]]) + (~1) + 1
-        memory[registers[str(operand)]] = decimalToHex(tempA)
-    else:
-        tempA = hexToDecimal(memory[decimalToHex(operand)]) + (~1) + 1
-        memory[decimalToHex(operand)] = decimalToHex(tempA)
-    if tempA > unsignedMAX:
-        tempA = tempA - unsignedMAX
-        cf = 1
+        tempA = machine.readWord(machine.registers[operand]) + (~1) + 1
+        machine.writeWord(machine.registers[operand], tempA)
     else:
-        cf = 0
-    if tempA == 0:
-        zf = 1
-    else:
-        zf = 0
-    if utos(tempA) < 0:
-        sf = 1
-    else:
-        sf = 0
+        tempA = machine.readWord(operand) + (~1) + 1
+        machine.writeWord(operand, tempA)
+    machine.flag_result = machine.carry_result = tempA
 
 
 # Bitwise XOR operand with A and store result in A.
 # CC set => SF, ZF
-def xor(mode, operand):
-    #print("Mode: ", mode, "\t Operand: ", decimalToHex(operand))
-    global registers, memory, zf, sf
-    tempA = hexToDecimal(registers['1'])
+def xor(machine, mode, operand):
+    if operand == 0 and (mode == 1 or mode == 2):
+        raise noRegister()
+    tempA = machine.registers[1]
     if mode == 0:
         tempA = tempA ^ operand
     elif mode == 1:
-        tempA = tempA ^ hexToDecimal(registers[str(operand)])
+        tempA = tempA ^ machine.registers[operand]
     elif mode == 2:
-        tempA = tempA ^ hexToDecimal(memory[registers[str(operand)]])
-    else:
-        tempA = tempA ^ hexToDecimal(memory[decimalToHex(operand)])
-    if tempA == 0:
-        zf = 1
+        tempA = tempA ^ machine.readWord(machine.registers[operand])
     else:
-        zf = 0
-    if utos(tempA) < 0:
-        sf = 1
-    else:
-        sf = 0
-    registers['1'] = decimalToHex(tempA)
+        tempA = tempA ^ machine.readWord(operand)
+    machine.flag_result = tempA
+    machine.registers[1] = tempA
 
 
 # Bitwise AND operand with A and store result in A.
 # CC set => SF, ZF
-def andd(mode, operand):
-    #print("Mode: ", mode, "\t Operand: ", decimalToHex(operand))
-    global registers, memory, zf, sf
-    tempA = hexToDecimal(registers['1'])
+def andd(machine, mode, operand):
+    if operand == 0 and (mode == 1 or mode == 2):
+        raise noRegister()
+    tempA = machine.registers[1]
     if mode == 0:
         tempA = tempA & operand
     elif mode == 1:
-        tempA = tempA & hexToDecimal(registers[str(operand)])
+        tempA = tempA & machine.registers[operand]
     elif mode == 2:
-        tempA = tempA & hexToDecimal(memory[registers[str(operand)]])
-    else:
-        tempA = tempA & hexToDecimal(memory[decimalToHex(operand)])
-    if tempA == 0:
-        zf = 1
+        tempA = tempA & machine.readWord(machine.registers[operand])
     else:
-        zf = 0
-    if utos(tempA) < 0:
-        sf = 1
-    else:
-        sf = 0
-    registers['1'] = decimalToHex(tempA)
+        tempA = tempA & machine.readWord(operand)
+    machine.flag_result = tempA
+    machine.registers[1] = tempA
 
 
 # Bitwise OR operand with A and store result in A.
 # CC set => SF, ZF
-def orr(mode, operand):
-    #print("Mode: ", mode, "\t Operand: ", decimalToHex(operand))
-    global registers, memory, zf, sf
-    tempA = hexToDecimal(registers['1'])
+def orr(machine, mode, operand):
+    if operand == 0 and (mode == 1 or mode == 2):
+        raise noRegister()
+    tempA = machine.registers[1]
     if mode == 0:
         tempA = tempA | operand
     elif mode == 1:
-        tempA = tempA | hexToDecimal(registers[str(operand)])
+        tempA = tempA | machine.registers[operand]
     elif mode == 2:
-        tempA = tempA | hexToDecimal(memory[registers[str(operand)]])
-    else:
-        tempA = tempA | hexToDecimal(memory[decimalToHex(operand)])
-    if tempA == 0:
-        zf = 1
+        tempA = tempA | machine.readWord(machine.registers[operand])
     else:
-        zf = 0
-    if utos(tempA) < 0:
-        sf = 1
-    else:
-        sf = 0
-    registers['1'] = decimalToHex(tempA)
+        tempA = tempA | machine.readWord(operand)
+    machine.flag_result = tempA
+    machine.registers[1] = tempA
 
 
 # Bitwise NOT operand with A and store result in A.
 # CC set => SF, ZF
-def nott(mode, operand):
-    #print("Mode: ", mode, "\t Operand: ", decimalToHex(operand))
-    global registers, memory, zf, sf
+def nott(machine, mode, operand):
+    if operand == 0 and (mode == 1 or mode == 2):
+        raise noRegister()
     tempA = 0
     if mode == 0:
         tempA = ~operand
     elif mode == 1:
-        tempA = ~hexToDecimal(registers[str(operand)])
-        registers[str(operand)] = decimalToHex(tempA)
+        tempA = ~machine.registers[operand]
+        machine.registers[operand] = tempA & 0xFFFF
     elif mode == 2:
-        tempA = ~hexToDecimal(memory[registers[str(operand)]])
-        memory[registers[str(operand)]] = decimalToHex(tempA)
-    else:
-        tempA = ~hexToDecimal(memory[decimalToHex(operand)])
-        memory[decimalToHex(operand)] = decimalToHex(tempA)
-    if tempA == 0:
-        zf = 1
+        tempA = ~machine.readWord(machine.registers[operand])
+        machine.writeWord(machine.registers[operand], tempA)
     else:
-        zf = 0
-    if utos(tempA) < 0:
-        sf = 1
-    else:
-        sf = 0
+        tempA = ~machine.readWord(operand)
+        machine.writeWord(operand, tempA)
+    machine.flag_result = tempA
 
 
 # Shift the bits of register one position to the left.
 # CC set => CF, SF, ZF
-def shl(mode, operand):
-    #print("Mode: ", mode, "\t Operand: ", decimalToHex(operand))
-    global registers, memory, zf, cf, sf
-    tempA = hexToDecimal(registers[str(operand)])
+def shl(machine, mode, operand):
+    if operand == 0:
+        raise noRegister()
+    tempA = machine.registers[operand]
     if mode == 1:
         tempA = (tempA << 1)
-    if tempA > unsignedMAX:
-        tempA = tempA - unsignedMAX
-        cf = 1
-    else:
-        cf = 0
-    if tempA == 0:
-        zf = 1
-    else:
-        zf = 0
-    if utos(tempA) < 0:
-        sf = 1
-    else:
-        sf = 0
+    machine.flag_result = machine.carry_result = tempA
 
 
 # Shift the bits of register one position to the right.
 # CC set => SF, ZF
-def shr(mode, operand):
-    #print("Mode: ", mode, "\t Operand: ", decimalToHex(operand))
-    global registers, memory, zf, sf
-    tempA = hexToDecimal(registers[str(operand)])
+def shr(machine, mode, operand):
+    if operand == 0:
+        raise noRegister()
+    tempA = machine.registers[operand]
     if mode == 1:
         tempA = (tempA >> 1)
-    if tempA == 0:
-        zf = 1
-    else:
-        zf = 0
-    if utos(tempA) < 0:
-        sf = 1
-    else:
-        sf = 0
+    machine.flag_result = tempA
 
 
 # NOP: No operation.
-def nop():
+# Also used for the opcodes that are not defined by the CPU.
+def nop(machine, mode, operand):
     return
 
 
-#   Push the word to the stack
-#   And decrement stack pointer by 2
-def pushh(mode, operand):
-    global stack_pointer, stack, registers
+# Raised when PUSH runs into the program or POP finds the stack empty.
+class StackError(Exception):
+    pass
+
+
+#   Decrement stack pointer by 2
+#   And write the word to the memory at the stack pointer
+def pushh(machine, mode, operand):
     if mode != 1:
         return
-    tempA = hexToDecimal(registers[str(operand)])
-    stack.append(tempA)
-    stack_pointer = stack_pointer - 2
+    stack_pointer = machine.stack_pointer - 2
+    if stack_pointer < machine.stack_limit:
+        raise StackError('stack overflow at %04X' % machine.program_counter)
+    if operand == 0:
+        raise noRegister()
+    machine.writeWord(stack_pointer, machine.registers[operand])
+    machine.stack_pointer = stack_pointer
 
 
-#   Pop the word from the stack
+#   Read the word at the stack pointer
 #   And increment stack pointer by 2
-def popp(mode, operand):
+def popp(machine, mode, operand):
     if mode != 1:
         return
-    global stack_pointer, stack, registers
-    popped = stack.pop()
-    registers[str(operand)] = popped
-    stack_pointer = stack_pointer + 2 
+    stack_pointer = machine.stack_pointer
+    if stack_pointer >= STACK_BOTTOM:
+        raise StackError('stack underflow at %04X' % machine.program_counter)
+    if operand == 0:
+        raise noRegister()
+    machine.registers[operand] = machine.readWord(stack_pointer)
+    machine.stack_pointer = stack_pointer + 2
 
 
 # Perform comparison with A-operand and set flag accordingly.
 # CC set => SF, ZF, CF
-def cmp(mode, operand):
-    #print("Mode: ", mode, "\t Operand: ", decimalToHex(operand))
-    global registers, memory, zf, cf, sf
-    tempA = hexToDecimal(registers['1'])
+def cmp(machine, mode, operand):
+    if operand == 0 and (mode == 1 or mode == 2):
+        raise noRegister()
+    tempA = machine.registers[1]
     if mode == 0:
         tempA = tempA + ~(operand) + 1
     elif mode == 1:
-        tempA = tempA + ~(hexToDecimal(registers[str(operand)])) + 1
+        tempA = tempA + ~(machine.registers[operand]) + 1
     elif mode == 2:
-        tempA = tempA + ~(hexToDecimal(memory[registers[str(operand)]])) + 1
+        tempA = tempA + ~(machine.readWord(machine.registers[operand])) + 1
     else:
-        tempA = tempA + ~(hexToDecimal(memory[decimalToHex(operand)])) + 1
-    if tempA > unsignedMAX:
-        tempA = tempA - unsignedMAX
-        cf = 1
-    else:
-        cf = 0
-    if tempA == 0:
-        zf = 1
-    else:
-        zf = 0
-    if utos(tempA) < 0:
-        sf = 1
-    else:
-        sf = 0
+        tempA = tempA + ~(machine.readWord(operand)) + 1
+    machine.flag_result = machine.carry_result = tempA
 
 
 # Unconditional jump. Set PC to address.
-def jmp(mode, address):
-    global program_counter, registers, memory
+# Returns True so that the main loop does not move the PC past the jump.
+def jmp(machine, mode, address):
+    if address == 0 and (mode == 1 or mode == 2):
+        raise noRegister()
     tempA = 0
     if mode == 0:
         tempA = address
     elif mode == 1:
-        tempA = hexToDecimal(registers[str(address)])
+        tempA = machine.registers[address]
     elif mode == 2:
-        tempA = hexToDecimal(memory[registers[str(address)]])
+        tempA = machine.readWord(machine.registers[address])
     else:
-        tempA = hexToDecimal(memory[decimalToHex(address)])
-    program_counter = decimalToHex(tempA)
+        tempA = machine.readWord(address)
+    machine.program_counter = tempA
+    return True
+
+
+# Build the handler of a conditional jump from its flag predicate.
+# The jump is only taken when the predicate holds for the current flags.
+def conditionalJump(condition):
+    def handler(machine, mode, address):
+        if condition(machine):
+            return jmp(machine, mode, address)
+    return handler
 
 
 # Prints the operand as a character.
-def printchar(mode, operand):
-    #print("Mode: ", mode, "\t Operand: ", decimalToHex(operand))
-    global registers, memory
+# The character goes to the output device, which writes it out later.
+def printchar(machine, mode, operand):
+    if operand == 0 and (mode == 1 or mode == 2):
+        raise noRegister()
     if mode == 0:
-        print(chr(operand))
+        machine.output.write(operand)
     elif mode == 1:
-        print(chr(hexToDecimal(registers[str(operand)])))
+        machine.output.write(machine.registers[operand])
     elif mode == 2:
-        print(chr(hexToDecimal(memory[registers[str(operand)]])))
+        machine.output.write(machine.readWord(machine.registers[operand]))
     else:
-        print(chr(hexToDecimal(memory[decimalToHex(operand)])))
-    
+        machine.output.write(machine.readWord(operand))
+
 
 # Reads a character into the operand.
-def readchar(mode, operand):
-    global registers, memory
-    val = input()
+# Pending output is written out first when READ has to wait for the input,
+# so a prompt is visible before the program blocks.
+def readchar(machine, mode, operand):
+    if not machine.input.available():
+        machine.output.flush()
+    val = machine.input.read()
+    if operand == 0 and (mode == 1 or mode == 2):
+        raise noRegister()
     if mode == 1:
-        registers[str(operand)] = decimalToHex(ord(val))
+        machine.registers[operand] = val & 0xFFFF
     elif mode == 2:
-        memory[registers[str(operand)]] = decimalToHex(ord(val))
-    else:
-        memory[decimalToHex(operand)] = decimalToHex(ord(val))
-
-
-if len(sys.argv) != 2: print('usage: executor.py <sourcefile>'); sys.exit(1)
-f = open(sys.argv[1], 'r')
-counter = 0x0
-while True:  # read in the source line
-    line = f.readline()
-    if not line: break
-    lines.append(line.strip())  # store each line without leading/trailing whitespaces
-
-    ## Here the instructions are saved in the memory in hex
-    memory[decimalToHex(counter)] = line.strip()
-    counter = counter + 3
-f.close()
-
-
-while True:
-    #print("PC:", program_counter)
-    #print("CF:", cf, "\tZF:", zf, "\tSF:", sf)
-    #print(registers)
-    #print(memory)
-    opcode, mode, operand = parseBits(memory[program_counter])
-    hexOpCode = binaryToHex(opcode).upper()
-    modeInt = int(mode,2)
-    operandInt = int(operand,2)
-    # HALT
-    if hexOpCode == '01':
-        break
-    elif hexOpCode == '02':
-        load(modeInt, operandInt)
-    elif hexOpCode == '03':
-        store(modeInt, operandInt)
-    elif hexOpCode == '04':
-        add(modeInt, operandInt)
-    elif hexOpCode == '05':
-        sub(modeInt, operandInt)
-    elif hexOpCode == '06':
-        inc(modeInt, operandInt)
-    elif hexOpCode == '07':
-        dec(modeInt, operandInt)
-    elif hexOpCode == '08':
-        xor(modeInt, operandInt)
-    elif hexOpCode == '09':
-        andd(modeInt, operandInt)
-    elif hexOpCode == '0A':
-        orr(modeInt, operandInt)
-    elif hexOpCode == '0B':
-        nott(modeInt, operandInt)
-    elif hexOpCode == '0C':
-        shl(modeInt, operandInt)
-    elif hexOpCode == '0D':
-        shr(modeInt, operandInt)
-    elif hexOpCode == '0E':
-        nop()
-    elif hexOpCode == '0F':
-        pushh(modeInt, operandInt)
-    elif hexOpCode == '10':
-        popp(modeInt, operandInt)
-    elif hexOpCode == '11':
-        cmp(modeInt, operandInt)
-    elif hexOpCode == '12':
-        jmp(modeInt, operandInt)
-        continue
-    elif hexOpCode == '13':
-        if zf == 1:
-            jmp(modeInt, operandInt)
-            continue
-    elif hexOpCode == '14':
-        if zf == 0:
-            jmp(modeInt, operandInt)
-            continue
-    elif hexOpCode == '15':
-        if cf == 1:
-            jmp(modeInt, operandInt)
-            continue
-    elif hexOpCode == '16':
-        if cf == 0:
-            jmp(modeInt, operandInt)
-            continue
-    elif hexOpCode == '17':
-        if cf == 0 and zf == 0:
-            jmp(modeInt, operandInt)
-            continue
-    elif hexOpCode == '18':
-        if cf == 0:
-            jmp(modeInt, operandInt)
-            continue
-    elif hexOpCode == '19':
-        if cf == 1:
-            jmp(modeInt, operandInt)
-            continue
-    elif hexOpCode == '1A':
-        if cf == 1 or zf == 1:
-            jmp(modeInt, operandInt)
-            continue
-    elif hexOpCode == '1B':
-        readchar(modeInt, operandInt)
-    elif hexOpCode == '1C':
-        printchar(modeInt,operandInt)
-    program_counter = decimalToHex(int(program_counter,16) + 3).zfill(4)
+        machine.writeWord(machine.registers[operand], val)
+    else:
+        machine.writeWord(operand, val)
+
+
+#######----- DISPATCH TABLE -----#######
+
+# Flag predicates of the conditional jumps.
+# They test the recorded ALU results directly instead of going through
+# the zf/cf properties: ZF is set when flag_result == 0 and CF is set when
+# carry_result > unsignedMAX.
+jumpConditions = {
+    0x13: lambda machine: machine.flag_result == 0,             # JZ, JE
+    0x14: lambda machine: machine.flag_result != 0,             # JNZ, JNE
+    0x15: lambda machine: machine.carry_result > unsignedMAX,   # JC
+    0x16: lambda machine: machine.carry_result <= unsignedMAX,  # JNC
+    0x17: lambda machine: machine.carry_result <= unsignedMAX and machine.flag_result != 0,  # JA
+    0x18: lambda machine: machine.carry_result <= unsignedMAX,  # JAE
+    0x19: lambda machine: machine.carry_result > unsignedMAX,   # JB
+    0x1A: lambda machine: machine.carry_result > unsignedMAX or machine.flag_result == 0,    # JBE
+}
+
+# Handlers indexed by the integer opcode (6 bits -> 64 slots).
+# Undefined opcodes behave like NOP. HALT is handled by the main loop.
+# A handler returns True when it has already set the PC itself.
+handlers = [nop] * 64
+handlers[0x02] = load
+handlers[0x03] = store
+handlers[0x04] = add
+handlers[0x05] = sub
+handlers[0x06] = inc
+handlers[0x07] = dec
+handlers[0x08] = xor
+handlers[0x09] = andd
+handlers[0x0A] = orr
+handlers[0x0B] = nott
+handlers[0x0C] = shl
+handlers[0x0D] = shr
+handlers[0x0E] = nop
+handlers[0x0F] = pushh
+handlers[0x10] = popp
+handlers[0x11] = cmp
+handlers[0x12] = jmp
+for jumpOpCode, condition in jumpConditions.items():
+    handlers[jumpOpCode] = conditionalJump(condition)
+handlers[0x1B] = readchar
+handlers[0x1C] = printchar
+
+# ------------------------------------ #
+
+
+#######----- MACHINE -----#######
+
+# Zero bytes used to clear the memory on reset without allocating a new array.
+blankMemory = bytes(MEMORY_SIZE + 2)
+
+# A flag_result that reads as ZF = 0 and SF = 0, the state before any ALU operation.
+initialFlagResult = 2 * unsignedMAX + 1
+
+# Snapshots (see Machine.snapshot): a header with the registers and the
+# machine state, a bitmap of the memory pages that are not all zero and
+# the contents of those pages.
+snapshotHeader = struct.Struct('>4sB5HHHIIiiBQ')
+SNAPSHOT_MAGIC = b'C23S'
+SNAPSHOT_VERSION = 1
+PAGE_SIZE = 256
+pageCount = (MEMORY_SIZE + 2 + PAGE_SIZE - 1) // PAGE_SIZE
+zeroPage = bytes(PAGE_SIZE)
+
+# A CPU230 machine: registers, condition codes, memory and the program counter.
+# One instance can run any number of programs one after the other:
+#
+#   machine = Machine()
+#   machine.load(readProgram('program.bin'))
+#   machine.run()
+#   machine.reset()
+#
+# PRINT and READ go through the output and input devices (see devices.py),
+# by default the buffered sys.stdout and sys.stdin.
+class Machine:
+    __slots__ = ('registers', 'memory', 'decoded', 'code_end', 'program_counter',
+                 'stack_pointer', 'stack_limit', 'flag_result', 'carry_result', 'halted', 'steps',
+                 'blocks', 'block_pages', 'dropped_blocks', 'input', 'output')
+
+    def __init__(self, inputDevice=None, outputDevice=None):
+        self.input = InputStream() if inputDevice is None else inputDevice
+        self.output = OutputBuffer() if outputDevice is None else outputDevice
+        # Registers [A,B,C,D,E] -> for simplicity used 1,2,3,4,5
+        # Index 0 is not a register, it is only there so the register
+        # number in the operand can be used as the index directly.
+        # The handlers fail on register 0, so it always stays 0.
+        self.registers = [0, 0, 0, 0, 0, 0]
+        self.memory = bytearray(MEMORY_SIZE + 2)
+        # Decoded instructions keyed by their memory address.
+        # Every entry is an (opcode, mode, operand) tuple of integers so the main loop
+        # does not decode the instruction bytes on every step.
+        # Entries are dropped whenever the bytes they were decoded from are written.
+        # Loading a program decodes nothing, instructions get their entry when
+        # they are first fetched (or compiled by the jit). A machine that ran
+        # a small program holds little more than its memory.
+        self.decoded = {}
+        # End of the code (exclusive). Writes below it may overwrite instructions.
+        self.code_end = 0
+        # Compiled basic blocks keyed by their entry address (see jit.py).
+        # A write into the code drops the blocks it overlaps, block_pages
+        # holds the entry addresses of the blocks in every 256 byte page.
+        # dropped_blocks counts how often the block of an entry address was
+        # dropped that way since the last reset.
+        self.blocks = {}
+        self.block_pages = {}
+        self.dropped_blocks = {}
+        self.reset()
+
+    # Bring the machine back to its power-on state.
+    # The memory is cleared, so a program has to be loaded again.
+    # The devices are kept, output still pending from the last run is written out.
+    def reset(self):
+        self.output.flush()
+        self.registers[:] = (0, 0, 0, 0, 0, 0)
+        self.memory[:] = blankMemory
+        self.decoded.clear()
+        self.clearBlocks()
+        self.dropped_blocks.clear()
+        self.code_end = 0
+        # Program Counter will shows the current instruction.
+        self.program_counter = 0
+        # Stack pointer represents the maximum address of the memory
+        # When something pushed to the stack it will grow the opposite way of the addresses.
+        self.stack_pointer = STACK_BOTTOM
+        # Lowest address the stack may grow to, raised by load() above the program.
+        self.stack_limit = 0
+        # Condition codes start cleared: ZF = CF = SF = 0.
+        self.flag_result = initialFlagResult
+        self.carry_result = 0
+        self.halted = False
+        # Number of instructions executed since the last reset (HALT included).
+        self.steps = 0
+
+    # Load a program file: an object file or a text .bin file.
+    def loadFile(self, path, address=0):
+        if isObjectFile(path):
+            with ObjectFile(path) as program:
+                self.load(program, address)
+        else:
+            self.load(readProgram(path), address)
+
+    # Condition codes, computed from the last recorded results.
+    # An operation with carry subtracts unsignedMAX from results above it,
+    # ZF tells whether that adjusted result is 0 and SF whether it is
+    # negative as a signed word (see utos), i.e. adjusted < 65536.
+    @property
+    def zf(self):
+        return 1 if self.flag_result == 0 else 0
+
+    @property
+    def cf(self):
+        return 1 if self.carry_result > unsignedMAX else 0
+
+    @property
+    def sf(self):
+        result = self.flag_result
+        if result > unsignedMAX:
+            result = result - unsignedMAX
+        return 1 if utos(result) < 0 else 0
+
+    # Place the program in the memory starting from the address.
+    # The program is one of:
+    # - instructions as 24-bit integers or hexadecimal strings like '080041',
+    # - packed 3-byte instructions (bytes, bytearray or memoryview), which are
+    #   copied as they are,
+    # - a Program from the assembler or an ObjectFile, whose entry point
+    #   also becomes the PC.
+    # The stack may not grow into the loaded code or the data segment of a Program.
+    def load(self, program, address=0):
+        memory = self.memory
+        self.clearBlocks()
+        dataEnd = 0
+        if isinstance(program, (Program, ObjectFile)):
+            self.program_counter = program.entry
+            dataEnd = program.data_end
+            program = program.code
+        if not isinstance(program, (bytes, bytearray, memoryview)):
+            program = b''.join((int(instruction, 16) if isinstance(instruction, str) else instruction)
+                               .to_bytes(3, 'big') for instruction in program)
+        end = address + len(program)
+        if end > MEMORY_SIZE:
+            raise ValueError('program does not fit in the memory')
+        memory[address:end] = program
+        decoded = self.decoded
+        for start in [start for start in decoded if address - 2 < start < end]:
+            del decoded[start]
+        if end > self.code_end:
+            self.code_end = end
+        self.stack_limit = max(self.stack_limit, self.code_end, dataEnd)
+
+    # Decode the 3 instruction bytes at the address and cache the result.
+    def decodeAt(self, address):
+        memory = self.memory
+        instruction = (memory[address] >> 2, memory[address] & 0x3,
+                       memory[address + 1] << 8 | memory[address + 2])
+        self.decoded[address] = instruction
+        if address + 3 > self.code_end:
+            self.code_end = address + 3
+            self.clearBlocks()
+        return instruction
+
+    # Read the 2-byte word at the address.
+    def readWord(self, address):
+        return self.memory[address] << 8 | self.memory[address + 1]
+
+    # Write the 2-byte word at the address.
+    # Instructions overlapping the written bytes are decoded again on their next fetch.
+    def writeWord(self, address, value):
+        self.memory[address] = (value >> 8) & 0xFF
+        self.memory[address + 1] = value & 0xFF
+        if address < self.code_end:
+            decoded = self.decoded
+            for start in range(max(address - 2, 0), min(address + 2, MEMORY_SIZE)):
+                decoded.pop(start, None)
+            if self.blocks:
+                self.dropBlocks(address)
+
+    # Drop all compiled blocks.
+    def clearBlocks(self):
+        self.blocks.clear()
+        self.block_pages.clear()
+
+    # Drop the compiled blocks overlapping the word written at the address.
+    # A block covers the 3 bytes of each of its block.length instructions.
+    def dropBlocks(self, address):
+        blocks = self.blocks
+        for page in {(address >> 8) & 0xFF, ((address + 1) >> 8) & 0xFF}:
+            entries = self.block_pages.get(page)
+            if not entries:
+                continue
+            for entry in list(entries):
+                block = blocks.get(entry)
+                if block is None:
+                    entries.discard(entry)
+                elif (address - entry) & 0xFFFF < block.length * 3 or (entry - address) & 0xFFFF < 2:
+                    del blocks[entry]
+                    entries.discard(entry)
+                    self.dropped_blocks[entry] = self.dropped_blocks.get(entry, 0) + 1
+
+    # Save the complete machine state into a compact binary blob.
+    # Only the memory pages that are not all zero are stored. The devices
+    # and the caches are not part of the state.
+    def snapshot(self):
+        memory = self.memory
+        bitmap = bytearray((pageCount + 7) // 8)
+        pages = []
+        for page in range(pageCount):
+            start = page * PAGE_SIZE
+            data = memory[start:start + PAGE_SIZE]
+            if data != zeroPage[:len(data)]:
+                bitmap[page >> 3] |= 0x80 >> (page & 7)
+                pages.append(data)
+        head = snapshotHeader.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, *self.registers[1:],
+                                   self.program_counter, self.stack_pointer, self.stack_limit,
+                                   self.code_end, self.flag_result, self.carry_result,
+                                   self.halted, self.steps)
+        return head + bytes(bitmap) + b''.join(pages)
+
+    # Bring the machine back to the state saved by snapshot().
+    # A blob that is cut short or too long is rejected before anything changes.
+    def restore(self, blob):
+        blob = memoryview(blob)
+        bitmapEnd = snapshotHeader.size + (pageCount + 7) // 8
+        if len(blob) < bitmapEnd:
+            raise ValueError('not a CPU230 snapshot')
+        fields = snapshotHeader.unpack_from(blob, 0)
+        if fields[0] != SNAPSHOT_MAGIC or fields[1] != SNAPSHOT_VERSION:
+            raise ValueError('not a CPU230 snapshot')
+        memory = self.memory
+        bitmap = blob[snapshotHeader.size:bitmapEnd]
+        pages = [page for page in range(pageCount) if bitmap[page >> 3] & (0x80 >> (page & 7))]
+        size = sum(min(PAGE_SIZE, len(memory) - page * PAGE_SIZE) for page in pages)
+        if len(blob) != bitmapEnd + size:
+            raise ValueError('snapshot of %d bytes, its page bitmap needs %d' % (len(blob), bitmapEnd + size))
+
+        (self.registers[1], self.registers[2], self.registers[3], self.registers[4],
+         self.registers[5]) = fields[2:7]
+        self.program_counter, self.stack_pointer, self.stack_limit = fields[7:10]
+        code_end = fields[10]
+        self.flag_result, self.carry_result = fields[11:13]
+        self.halted = bool(fields[13])
+        self.steps = fields[14]
+
+        # Every cached decode may be stale now.
+        self.decoded.clear()
+        self.clearBlocks()
+        self.dropped_blocks.clear()
+        self.code_end = code_end
+
+        memory[:] = blankMemory
+        offset = bitmapEnd
+        for page in pages:
+            start = page * PAGE_SIZE
+            end = min(start + PAGE_SIZE, len(memory))
+            memory[start:end] = blob[offset:offset + end - start]
+            offset = offset + end - start
+
+    # Execute a single instruction.
+    # Returns False when the machine is halted.
+    def step(self):
+        return self.run(1) == 1 and not self.halted
+
+    # Execute instructions until HALT or until max_steps instructions are executed.
+    # Returns the number of instructions executed by this call.
+    def run(self, max_steps=None):
+        if self.halted:
+            return 0
+        decoded = self.decoded
+        limit = -1 if max_steps is None else max_steps
+        steps = 0
+        try:
+            while steps != limit:
+                #print("PC:", self.program_counter)
+                #print("CF:", self.cf, "\tZF:", self.zf, "\tSF:", self.sf)
+                #print(self.registers)
+                # Instructions are decoded once and served from the cache afterwards.
+                program_counter = self.program_counter
+                try:
+                    instruction = decoded[program_counter]
+                except KeyError:
+                    instruction = self.decodeAt(program_counter)
+                opcode, modeInt, operandInt = instruction
+                steps = steps + 1
+                # HALT
+                if opcode == 0x01:
+                    self.halted = True
+                    self.output.flush()
+                    break
+                if handlers[opcode](self, modeInt, operandInt):
+                    continue
+                self.program_counter = (program_counter + 3) & 0xFFFF
+        finally:
+            # Also counted when a handler raises, the failing instruction included.
+            self.steps = self.steps + steps
+        return steps
+
+# ------------------------------------ #
+
+
+# Read a text .bin file: one hexadecimal instruction per line.
+def readProgram(path):
+    with open(path, 'r') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def main(argv):
+    useJit = '--jit' in argv[1:]
+    argv = [arg for arg in argv if arg != '--jit']
+    if len(argv) != 2: print('usage: executor.py [--jit] <sourcefile>'); sys.exit(1)
+    machine = Machine()
+    machine.loadFile(argv[1])
+    try:
+        if useJit:
+            import jit
+            jit.run(machine)
+        else:
+            machine.run()
+    finally:
+        machine.output.flush()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
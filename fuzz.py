@@ -0,0 +1,491 @@
+#!/usr/bin/python
+
+import argparse
+import os
+import random
+import string
+import sys
+import time
+
+import jit
+from assembler import addressingModes, assemble, jumpNames, opCodeNumbers, opCodes, registers
+from devices import InputStream, OutputCapture
+from executer import Machine
+from incremental import BuildCache, assembleIncremental
+from watchdog import cycleCosts, runGuarded, stepRun
+
+try:
+    from lanes import LaneBatch
+except ImportError:
+    LaneBatch = None
+
+try:
+    import numpy as np
+    from analysis import ControlFlowGraph, decode
+except ImportError:
+    ControlFlowGraph = None
+
+
+## Differential fuzzer: runs random CPU230 programs in the interpreter
+## (Machine.run, the reference) and in the faster tiers, and compares them.
+##
+## The programs are generated from the assembler's opCodes and
+## addressingModes tables, with labels for the jumps and now and then a
+## tight loop of the kind the jit fast-forwards. Every program gets a
+## few READ inputs and runs once per input. The tiers:
+##
+## - jit:         jit.run on the same program and input.
+## - lanes:       all inputs at once as the lanes of a LaneBatch (needs NumPy).
+## - snapshot:    runs half of the budget, continues on a second machine
+##                restored from a snapshot of the first.
+## - peephole:    the program assembled with the peephole optimizer. Only for
+##                programs that never compute a code address, and only the
+##                registers, flags, output and the memory from DATA_START
+##                up are compared, since the code moves.
+## - incremental: assembleIncremental() must give the same code as
+##                assemble(), before and after a random line was edited.
+## - watchdog:    runGuarded() running blocks, with random budgets and cycle
+##                costs, against stepRun() executing one instruction at a
+##                time. The cycles are compared as well.
+## - analysis:    the reachable instructions of analysis.py's basic blocks
+##                against a search over single instructions (needs NumPy).
+##
+## The final registers, flags, PC, stack pointer, memory, PRINT output,
+## step count and the way the run ended (HALT, budget or the type of the
+## error) are compared, after a fault as well.
+##
+## A diverging program is shrunk by dropping lines and emptying inputs while
+## it still diverges, and written as fuzz-<tier>-<seed>-<case>.asm with its
+## inputs in the .in file next to it, one line per input as lanes.py reads
+## them.
+##
+## usage: fuzz.py [--seed N] [--cases N] [--duration S] [--max-steps N]
+##                [--tiers jit,lanes,...] [--output DIR]
+##
+## Exits with status 1 when a tier diverged.
+
+
+# Memory the peephole tier compares: generated programs keep their data here.
+DATA_START = 0x8000
+
+INPUTS_PER_CASE = 3
+
+registerNames = sorted(registers)
+modeNames = sorted(addressingModes, key=addressingModes.get)
+instructionNames = sorted(name for name in opCodes if name != 'HALT')
+# Opcodes that write to the memory when their operand is an immediate address.
+immediateWriters = ('STORE', 'READ')
+
+
+# A generated program: its source lines and the READ input of every run.
+# relocatable programs never compute a code address, so the peephole
+# optimizer may move their code.
+class Case:
+    __slots__ = ('lines', 'inputs', 'relocatable')
+
+    def __init__(self, lines, inputs, relocatable):
+        self.lines = lines
+        self.inputs = inputs
+        self.relocatable = relocatable
+
+    def source(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+#######----- GENERATOR -----#######
+
+# A number operand: the assembler reads digits-only operands as hexadecimal.
+def randomNumber(rng):
+    return '%d' % rng.choice((0, 1, 2, rng.randrange(10), rng.randrange(100), rng.randrange(10000)))
+
+
+# An address for the memory addressing mode: mostly data, sometimes the
+# stack, the last word of the memory or the code itself.
+def randomAddress(rng, length, relocatable):
+    choices = [DATA_START + rng.randrange(256), DATA_START + rng.randrange(256), 0xFFFE, 0xFFFF]
+    if not relocatable:
+        choices.append(rng.randrange(3 * length + 3))
+    return '[%04X]' % rng.choice(choices)
+
+
+def randomInstruction(rng, labels, length, relocatable):
+    if rng.random() < 0.01:
+        return 'HALT'
+    name = rng.choice(instructionNames)
+    if name == 'NOP':
+        return name
+    if name in jumpNames:
+        if not relocatable and rng.random() < 0.1:
+            return '%s %s' % (name, rng.choice(registerNames + ['[%s]' % rng.choice(registerNames)]))
+        return '%s %s' % (name, rng.choice(labels))
+    if name in ('PUSH', 'POP', 'SHL', 'SHR') and rng.random() < 0.8:
+        mode = 'register'
+    else:
+        mode = rng.choice(modeNames)
+    if mode == 'regmem' and relocatable:
+        mode = 'memory'
+    if mode == 'immediate':
+        if name in immediateWriters:
+            operand = '%d' % (8000 + rng.randrange(100)) if relocatable else randomNumber(rng)
+        elif rng.random() < 0.2:
+            operand = "'%s'" % rng.choice(string.ascii_letters + string.digits)
+        else:
+            operand = randomNumber(rng)
+    elif mode == 'register':
+        operand = rng.choice(registerNames)
+    elif mode == 'regmem':
+        operand = '[%s]' % rng.choice(registerNames)
+    else:
+        operand = randomAddress(rng, length, relocatable)
+    return '%s %s' % (name, operand)
+
+
+# A loop the block compiler fast-forwards: INC, DEC and NOP jumping back
+# to the label with JNZ (or JMP, which never exits).
+def randomTightLoop(rng, label):
+    lines = [label + ':']
+    for _ in range(rng.randint(0, 4)):
+        lines.append(rng.choice(('NOP', 'INC %s', 'DEC %s', 'DEC %s')).replace('%s', rng.choice(registerNames)))
+    lines.append('%s %s' % ('JMP' if rng.random() < 0.1 else 'JNZ', label))
+    return lines
+
+
+# Generate a random program of about length instructions ending with HALT.
+def generateCase(rng, length):
+    relocatable = rng.random() < 0.5
+    labels = ['L%d' % index for index in range(max(1, length // 4))]
+    positions = {}
+    for label in labels:
+        positions.setdefault(rng.randrange(length + 1), []).append(label)
+    lines = []
+    for index in range(length + 1):
+        lines.extend(label + ':' for label in positions.get(index, ()))
+        if index < length and rng.random() < 0.02:
+            lines.extend(randomTightLoop(rng, 'T%d' % index))
+        lines.append(randomInstruction(rng, labels, length, relocatable) if index < length else 'HALT')
+    inputs = [''.join(rng.choice(string.ascii_letters) for _ in range(rng.randint(0, 6)))
+              for _ in range(INPUTS_PER_CASE)]
+    return Case(lines, inputs, relocatable)
+
+# ------------------------------------ #
+
+
+#######----- TIERS -----#######
+
+stateKeys = ('status', 'error', 'steps', 'program_counter', 'stack_pointer',
+             'registers', 'flags', 'memory', 'output')
+
+
+def newMachine(program, input):
+    machine = Machine(InputStream(input), OutputCapture())
+    machine.load(program)
+    return machine
+
+
+# The state a run ended in, compared between the tiers.
+def machineState(machine, status, error=None):
+    return {
+        'status': status,
+        'error': error,
+        'steps': machine.steps,
+        'program_counter': machine.program_counter,
+        'stack_pointer': machine.stack_pointer,
+        'registers': machine.registers[:],
+        'flags': (machine.zf, machine.cf, machine.sf),
+        'memory': bytes(machine.memory),
+        'output': machine.output.getvalue(),
+    }
+
+
+# Run the loaded machine with run() for at most budget instructions.
+def runMachine(machine, run, budget):
+    try:
+        run(machine, budget)
+    except Exception as error:
+        return machineState(machine, 'fault', type(error).__name__)
+    return machineState(machine, 'halted' if machine.halted else 'max_steps')
+
+
+def referenceStates(program, case, budget):
+    return [runMachine(newMachine(program, input), Machine.run, budget) for input in case.inputs]
+
+
+# Name and the two values of the first difference, None when they agree.
+def firstDifference(states, references, keys):
+    for index, (state, reference) in enumerate(zip(states, references)):
+        for key in keys:
+            if state[key] != reference[key]:
+                if key == 'memory':
+                    address = next(address for address, (a, b) in enumerate(zip(state[key], reference[key]))
+                                   if a != b)
+                    return 'input %d: memory[%04X] is %02X, expected %02X' % (
+                        index, address, state[key][address], reference[key][address])
+                return 'input %d: %s is %r, expected %r' % (index, key, state[key], reference[key])
+    return None
+
+
+def checkJit(case, program, references, budget):
+    states = [runMachine(newMachine(program, input), jit.run, budget) for input in case.inputs]
+    return firstDifference(states, references, stateKeys)
+
+
+def checkSnapshot(case, program, references, budget):
+    states = []
+    for input in case.inputs:
+        machine = newMachine(program, input)
+        state = runMachine(machine, Machine.run, budget // 2)
+        if state['status'] == 'max_steps':
+            restored = Machine(machine.input, machine.output)
+            restored.restore(machine.snapshot())
+            state = runMachine(restored, Machine.run, budget - restored.steps)
+        states.append(state)
+    return firstDifference(states, references, stateKeys)
+
+
+def checkLanes(case, program, references, budget):
+    batch = LaneBatch(program, case.inputs)
+    batch.run(budget)
+    states = []
+    for lane in range(batch.count):
+        result = batch.result(lane)
+        states.append({
+            'status': result['status'],
+            'error': result['error'].split(':', 1)[0] if 'error' in result else None,
+            'steps': result['steps'],
+            'program_counter': int(batch.program_counter[lane]),
+            'stack_pointer': int(batch.stack_pointer[lane]),
+            'registers': batch.registers[lane].tolist(),
+            'flags': batch.flags(lane),
+            'memory': batch.memory[:, lane].tobytes(),
+            'output': result['output'].encode('utf-8'),
+        })
+    return firstDifference(states, references, stateKeys)
+
+
+def checkPeephole(case, program, references, budget):
+    if not case.relocatable or any(reference['status'] == 'max_steps' for reference in references):
+        return None
+    optimized = assemble(case.lines, optimizations={})
+    states = []
+    for input in case.inputs:
+        state = runMachine(newMachine(optimized, input), Machine.run, budget)
+        state['data'] = state['memory'][DATA_START:]
+        states.append(state)
+    for reference in references:
+        reference['data'] = reference['memory'][DATA_START:]
+    keys = ('status', 'error', 'registers', 'flags', 'output', 'data')
+    return firstDifference(states, references, keys)
+
+
+def checkIncremental(case, program, references, budget):
+    cache = BuildCache()
+    built, _ = assembleIncremental(case.source(), cache)
+    if built.code != program.code or built.symbols != program.symbols:
+        return 'code differs from assemble()'
+    # Edit one instruction and rebuild with the same cache.
+    rng = random.Random(case.source())
+    lines = list(case.lines)
+    edited = [index for index, line in enumerate(lines) if not line.endswith(':')]
+    labels = [line[:-1] for line in lines if line.endswith(':')] or ['L0']
+    index = rng.choice(edited)
+    lines[index] = randomInstruction(rng, labels, len(lines), case.relocatable)
+    try:
+        expected = assemble(lines)
+    except KeyError:
+        return None
+    built, _ = assembleIncremental('\n'.join(lines) + '\n', cache)
+    if built.code != expected.code or built.symbols != expected.symbols:
+        return 'code differs from assemble() after editing line %d to %r' % (index + 1, lines[index])
+    return None
+
+
+def checkWatchdog(case, program, references, budget):
+    rng = random.Random(case.source())
+    costs = cycleCosts({name: rng.randint(1, 5) for name in rng.sample(sorted(opCodeNumbers), 5)})
+    maxSteps = rng.choice((None, rng.randint(0, budget)))
+    maxCycles = rng.choice((None, rng.randint(0, 3 * budget)))
+    if maxSteps is None and maxCycles is None:
+        maxSteps = budget
+    states = []
+    expected = []
+    for input in case.inputs:
+        machine = newMachine(program, input)
+        report = runGuarded(machine, maxSteps, maxCycles, costs=costs)
+        error = report.error.split(':', 1)[0] if report.error is not None else None
+        states.append(dict(machineState(machine, report.status, error), cycles=report.cycles))
+        machine = newMachine(program, input)
+        try:
+            status, cycles = stepRun(machine, costs, maxSteps, maxCycles, None)
+            error = None
+        except Exception as failure:
+            status, cycles, error = 'fault', failure.cycles, type(failure).__name__
+        expected.append(dict(machineState(machine, status, error), cycles=cycles))
+    return firstDifference(states, expected, stateKeys + ('cycles',))
+
+
+# The instructions reachable from the entry, found one instruction at a time
+# with the rules analysis.py states: a jump through a register or the memory
+# may go to any instruction whose address is an immediate operand.
+def reachableInstructions(opcodes, modes, operands):
+    count = len(opcodes)
+    isJump = [0x12 <= opcode <= 0x1A for opcode in opcodes]
+    addressTaken = [operand // 3 for operand, mode, jump in zip(operands, modes, isJump)
+                    if mode == 0 and not jump and operand % 3 == 0 and operand // 3 < count]
+    reachable = set()
+    pending = [0]
+    while pending:
+        index = pending.pop()
+        if index >= count or index in reachable:
+            continue
+        reachable.add(index)
+        if opcodes[index] == 0x01:
+            continue
+        if isJump[index]:
+            if modes[index] != 0:
+                pending.extend(addressTaken)
+            elif operands[index] % 3 == 0:
+                pending.append(operands[index] // 3)
+            if opcodes[index] == 0x12:
+                continue
+        pending.append(index + 1)
+    return reachable
+
+
+def checkAnalysis(case, program, references, budget):
+    if not program.code:
+        return None
+    code = np.frombuffer(program.code, dtype=np.uint8).astype(np.uint32).reshape(-1, 3)
+    opcodes, modes, operands = decode(code[:, 0] << 16 | code[:, 1] << 8 | code[:, 2])
+    graph = ControlFlowGraph(opcodes, modes, operands)
+    found = set()
+    for block in np.flatnonzero(graph.reachable).tolist():
+        found.update(range(int(graph.starts[block]), int(graph.ends[block])))
+    expected = reachableInstructions(opcodes.tolist(), modes.tolist(), operands.tolist())
+    if found != expected:
+        index = min(found ^ expected)
+        return 'instruction %04X is %s, expected %s' % (
+            index * 3, 'reachable' if index in found else 'unreachable',
+            'reachable' if index in expected else 'unreachable')
+    return None
+
+
+tiers = {
+    'jit': checkJit,
+    'lanes': checkLanes,
+    'snapshot': checkSnapshot,
+    'peephole': checkPeephole,
+    'incremental': checkIncremental,
+    'watchdog': checkWatchdog,
+    'analysis': checkAnalysis,
+}
+
+# ------------------------------------ #
+
+
+# Run the tier on the case. Returns the difference or None.
+# reference is the assembled program and the reference states when they are
+# known already. A case that does not assemble any more counts as agreeing.
+def checkCase(case, check, budget, reference=None):
+    if reference is None:
+        try:
+            program = assemble(case.lines)
+        except (KeyError, ValueError):
+            return None
+        reference = program, referenceStates(program, case, budget)
+    program, references = reference
+    try:
+        return check(case, program, references, budget)
+    except Exception as error:
+        return 'tier raised %s: %s' % (type(error).__name__, error)
+
+
+# Make the case smaller while the tier still diverges on it: drop chunks of
+# lines, halving the chunk size down to single lines, then empty the inputs.
+def shrink(case, check, budget):
+    lines = case.lines
+    chunk = max(1, len(lines) // 2)
+    while True:
+        index = 0
+        while index < len(lines):
+            candidate = Case(lines[:index] + lines[index + chunk:], case.inputs, case.relocatable)
+            if checkCase(candidate, check, budget) is not None:
+                lines = candidate.lines
+            else:
+                index = index + chunk
+        if chunk == 1:
+            break
+        chunk = chunk // 2
+    inputs = list(case.inputs)
+    for index in range(len(inputs)):
+        candidate = Case(lines, inputs[:index] + [''] + inputs[index + 1:], case.relocatable)
+        if inputs[index] and checkCase(candidate, check, budget) is not None:
+            inputs = candidate.inputs
+    return Case(lines, inputs, case.relocatable)
+
+
+def writeReproducer(directory, name, case):
+    path = os.path.join(directory, name)
+    with open(path + '.asm', 'w') as f:
+        f.write(case.source())
+    with open(path + '.in', 'w') as f:
+        f.writelines(input + '\n' for input in case.inputs)
+    return path + '.asm'
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='fuzz.py', description='Compare the CPU230 execution tiers on random programs.')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the first case (default: time based)')
+    parser.add_argument('--cases', type=int, default=1000, help='number of programs (default: 1000)')
+    parser.add_argument('--duration', type=float, default=None, help='stop after this many seconds')
+    parser.add_argument('--max-steps', type=int, default=2000, help='instruction budget per run')
+    parser.add_argument('--tiers', default=','.join(tiers), help='comma separated tiers to compare')
+    parser.add_argument('--output', default='.', help='directory for the reproducers')
+    arguments = parser.parse_args(argv[1:])
+
+    selected = [name.strip() for name in arguments.tiers.split(',') if name.strip()]
+    for name in selected:
+        if name not in tiers:
+            parser.error('unknown tier %r (known: %s)' % (name, ', '.join(tiers)))
+    if 'lanes' in selected and LaneBatch is None:
+        print('lanes: skipped, NumPy is not installed')
+        selected.remove('lanes')
+    if 'analysis' in selected and ControlFlowGraph is None:
+        print('analysis: skipped, NumPy is not installed')
+        selected.remove('analysis')
+    seed = arguments.seed if arguments.seed is not None else int(time.time())
+    budget = arguments.max_steps
+
+    divergences = dict.fromkeys(selected, 0)
+    instructions = 0
+    cases = 0
+    start = time.perf_counter()
+    for index in range(arguments.cases):
+        if arguments.duration is not None and time.perf_counter() - start > arguments.duration:
+            break
+        rng = random.Random(seed << 32 | index)
+        case = generateCase(rng, rng.randint(3, 40))
+        program = assemble(case.lines)
+        references = referenceStates(program, case, budget)
+        instructions = instructions + sum(reference['steps'] for reference in references)
+        cases = cases + 1
+        for name in selected:
+            difference = checkCase(case, tiers[name], budget, (program, references))
+            if difference is None:
+                continue
+            divergences[name] += 1
+            small = shrink(case, tiers[name], budget)
+            path = writeReproducer(arguments.output, 'fuzz-%s-%d-%d' % (name, seed, index), small)
+            print('%s: case %d diverges: %s' % (name, index, checkCase(small, tiers[name], budget)))
+            print('    reproducer (%d lines): %s' % (len(small.lines), path))
+
+    elapsed = time.perf_counter() - start
+    print('seed %d: %d programs, %d reference instructions in %.1fs (%.0f instructions/min)'
+          % (seed, cases, instructions, elapsed, instructions / elapsed * 60 if elapsed else 0))
+    for name in selected:
+        print('%s: %d diverging' % (name, divergences[name]))
+    if any(divergences.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
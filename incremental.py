@@ -0,0 +1,251 @@
+#!/usr/bin/python
+
+import hashlib
+import os
+import pickle
+import re
+import sys
+import time
+
+from assembler import IMMEDIATE, convertOperand, encodeInstruction, opCodeNumbers, parseLine
+from objectfile import Program
+
+
+## Incremental assembler with a persistent build cache.
+##
+## The source is split into chunks at its labels: every chunk starts with
+## the labels in front of its first instruction and runs up to the next
+## label. Each chunk is encoded on its own with label operands left at 0
+## and a list of the operands to patch. The cache keeps, by the hash of the
+## chunk's text:
+##
+## - the unpatched code, the operands to patch and the instruction count,
+## - the patched code and the label addresses it was patched with.
+##
+## A rebuild only encodes chunks whose text is new and only patches chunks
+## whose labels moved, everything else is copied from the cache. The result
+## is the same as assembler.py produces.
+##
+## usage: incremental.py [--binary] <sourcefile>
+##
+## writes <name>.bin (or <name>.obj with --binary) like assembler.py, with
+## the cache in .cpu230cache next to the source. The text .bin is only
+## rewritten from the first instruction that changed.
+
+
+CACHE_VERSION = 2
+
+# Lines of a single word: labels, and HALT or NOP without an operand.
+singleWordLine = re.compile(r'^[^\S\n]*(\S+)[^\S\n]*$', re.MULTILINE)
+
+
+# Encode the instructions of one chunk.
+# Returns (code, relocations, count): code holds the 3-byte instructions
+# with label operands left at 0, relocations the (index, label) pairs to patch.
+def encodeChunk(lines):
+    instructions = []
+    relocations = []
+    for line in lines:
+        item = parseLine(line)
+        if item is None or item[0] == 'label':
+            continue
+        _, name, operandText = item
+        if operandText is None:
+            mode, operand = IMMEDIATE, 0
+        else:
+            mode, operand = convertOperand(operandText, {})
+            if operand is None:
+                relocations.append((len(instructions), operandText))
+                operand = 0
+        instructions.append(encodeInstruction(opCodeNumbers[name], mode, operand))
+    code = b''.join(instruction.to_bytes(3, 'big') for instruction in instructions)
+    return code, tuple(relocations), len(instructions)
+
+
+# Split the source text into chunks.
+# Returns a list of (label, text) pairs: every label line starts a chunk
+# that runs up to the next one, the first chunk has no label. Consecutive
+# labels give empty chunks at the same address.
+# Only the label lines are looked at, the rest is split on a cache miss.
+def splitChunks(source):
+    chunks = []
+    label = None
+    start = 0
+    for match in singleWordLine.finditer(source):
+        word = match.group(1)
+        if word == 'HALT' or word == 'NOP':
+            continue
+        chunks.append((label, source[start:match.start()]))
+        label = word[:-1]
+        start = match.end()
+    chunks.append((label, source[start:]))
+    return chunks
+
+
+# The address every label operand of the chunk refers to, the same way
+# assembleLines() resolves it: a label already defined above the reference
+# means its latest definition, otherwise its last one.
+# final maps the labels to their last address, repeated holds the
+# definitions of the labels that are defined more than once.
+def resolve(relocations, chunkIndex, final, repeated):
+    addresses = []
+    for _, label in relocations:
+        address = final[label]
+        if label in repeated:
+            earlier = [defined for index, defined in repeated[label] if index <= chunkIndex]
+            if earlier:
+                address = earlier[-1]
+        addresses.append(address)
+    return tuple(addresses)
+
+
+# Patch the label addresses into the code of a chunk.
+def patchChunk(code, relocations, addresses):
+    code = bytearray(code)
+    for (index, _), address in zip(relocations, addresses):
+        offset = index * 3
+        instruction = int.from_bytes(code[offset:offset + 3], 'big') | address
+        code[offset:offset + 3] = instruction.to_bytes(3, 'big')
+    return bytes(code)
+
+
+class BuildCache:
+    def __init__(self, path=None):
+        self.path = path
+        # chunk hash -> [code, relocations, count, patched code, addresses]
+        self.chunks = {}
+        # The last build: hash of the whole source and its Program.
+        self.sourceHash = None
+        self.program = None
+        # The text .bin as it was last written: the code it holds, its size
+        # and modification time. --binary builds leave it as it is.
+        self.text = None
+        if path is not None:
+            self.read()
+
+    def read(self):
+        try:
+            with open(self.path, 'rb') as f:
+                state = pickle.load(f)
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            return
+        if state[0] == CACHE_VERSION:
+            _, self.sourceHash, self.program, self.chunks, self.text = state
+
+    def write(self):
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path + '.tmp', 'wb') as f:
+            pickle.dump((CACHE_VERSION, self.sourceHash, self.program, self.chunks, self.text), f,
+                        pickle.HIGHEST_PROTOCOL)
+        os.replace(self.path + '.tmp', self.path)
+
+
+# Assemble the source with the cache.
+# source is the whole text or an iterable of lines. Returns the Program and
+# the number of chunks, encoded chunks and patched chunks.
+def assembleIncremental(source, cache):
+    if not isinstance(source, str):
+        source = '\n'.join(source)
+    sourceHash = hashlib.sha256(source.encode('utf-8')).digest()
+    if sourceHash == cache.sourceHash and cache.program is not None:
+        return cache.program, (0, 0, 0)
+
+    chunks = splitChunks(source)
+    entries = []
+    encoded = 0
+    for _, text in chunks:
+        key = hashlib.sha256(text.encode('utf-8')).digest()
+        entry = cache.chunks.get(key)
+        if entry is None:
+            code, relocations, count = encodeChunk(line.strip() for line in text.splitlines())
+            entry = [code, relocations, count, None, None]
+            encoded = encoded + 1
+        entries.append((key, entry))
+
+    # Lay the chunks out one after the other.
+    definitions = {}
+    address = 0
+    for index, ((label, _), (_, entry)) in enumerate(zip(chunks, entries)):
+        if label is not None:
+            definitions.setdefault(label, []).append((index, address))
+        address = address + entry[2] * 3
+    final = {label: found[-1][1] for label, found in definitions.items()}
+    repeated = {label: found for label, found in definitions.items() if len(found) > 1}
+    codeSize = address
+
+    patched = 0
+    parts = []
+    used = {}
+    for index, (key, entry) in enumerate(entries):
+        addresses = resolve(entry[1], index, final, repeated) if entry[1] else ()
+        if entry[3] is None or entry[4] != addresses:
+            # A chunk used twice with different addresses keeps the last patch.
+            entry[3] = patchChunk(entry[0], entry[1], addresses) if entry[1] else entry[0]
+            entry[4] = addresses
+            patched = patched + 1
+        parts.append(entry[3])
+        used[key] = entry
+    code = b''.join(parts)
+
+    symbols = final
+    dataLabels = [address for address in symbols.values() if address >= codeSize]
+    dataEnd = max(dataLabels) + 2 if dataLabels else codeSize
+    program = Program(code, symbols, dataStart=codeSize, dataEnd=dataEnd)
+
+    # Chunks that are gone from the source are dropped from the cache.
+    cache.chunks = used
+    cache.sourceHash = sourceHash
+    cache.program = program
+    return program, (len(chunks), encoded, patched)
+
+
+# Write the text .bin, keeping the lines before the first changed instruction.
+# previous is what BuildCache.text recorded when the file was written, None
+# to write it all. The file is also written completely when its size or its
+# modification time are not the recorded ones, it was changed since.
+# Returns the new BuildCache.text.
+def updateText(path, code, previous=None):
+    start = 0
+    if previous is not None and os.path.exists(path):
+        previous, size, modified = previous
+        status = os.stat(path)
+        length = min(len(code), len(previous))
+        if status.st_size != size or status.st_mtime_ns != modified:
+            length = 0
+        while start < length and code[start:start + 3] == previous[start:start + 3]:
+            start = start + 3
+    # Every line is 6 hexadecimal digits and a newline.
+    offset = start // 3 * 7
+    mode = 'r+' if start else 'w'
+    with open(path, mode) as f:
+        f.seek(offset)
+        f.writelines('%06X\n' % (code[index] << 16 | code[index + 1] << 8 | code[index + 2])
+                     for index in range(start, len(code), 3))
+        f.truncate()
+    status = os.stat(path)
+    return code, status.st_size, status.st_mtime_ns
+
+
+def main(argv):
+    binaryOutput = '--binary' in argv[1:]
+    arguments = [arg for arg in argv if arg != '--binary']
+    if len(arguments) != 2: print('usage: incremental.py [--binary] <sourcefile>'); sys.exit(1)
+    path = arguments[1]
+    directory = os.path.join(os.path.dirname(os.path.abspath(path)), '.cpu230cache')
+    start = time.perf_counter()
+    cache = BuildCache(os.path.join(directory, os.path.basename(path) + '.build'))
+    with open(path, 'r') as f:
+        program, (chunks, encoded, patched) = assembleIncremental(f.read(), cache)
+    if binaryOutput:
+        program.writeObject(path[:-4] + '.obj')
+    else:
+        cache.text = updateText(path[:-4] + '.bin', program.code, cache.text)
+    cache.write()
+    print('%d chunks, %d encoded, %d patched in %.1fms'
+          % (chunks, encoded, patched, (time.perf_counter() - start) * 1000))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
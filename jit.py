@@ -0,0 +1,485 @@
+#!/usr/bin/python
+
+## Basic-block compiler for the CPU230 executer.
+##
+## Straight-line code is translated into the source of one Python function
+## per basic block and compiled with exec(). Running a block skips the
+## fetch/decode/dispatch work that Machine.run does for every instruction.
+##
+## - A block starts at the address it is entered from and ends after the
+##   first jump, HALT or READ (or after MAX_BLOCK_LENGTH instructions).
+## - Recorded ALU results (machine.flag_result / machine.carry_result) that
+##   are overwritten before anything can read them are left out of the
+##   generated code.
+## - Blocks are cached in machine.blocks by their entry address. A write
+##   into the code drops the blocks it overlaps (see Machine.dropBlocks),
+##   and a block returns right after one of its own writes lands in the code.
+## - An entry address whose block was dropped RECOMPILE_LIMIT times is not
+##   compiled any more, its block function lets Machine.run execute the
+##   instructions. Code that keeps writing itself is interpreted instead of
+##   being compiled again on every pass.
+##
+## The generated function takes the machine, executes the block, adds the
+## number of executed instructions to machine.steps and returns the address
+## of the next instruction.
+##
+## Tight loops are fast-forwarded: a block that jumps back to its own start
+## with JMP or JNZ, and in between only has NOP and INC / DEC of registers,
+## is not compiled. Its function computes how many times the loop runs
+## until JNZ falls through, in closed form from the register the last
+## INC / DEC counted, and applies all of those iterations at once. The
+## optional second argument of a block function is the number of
+## instructions it may execute, a loop stops after the last whole
+## iteration that fits. A loop that never exits without a budget runs
+## 65536 iterations per call, which leaves the registers and the flags
+## as they were.
+
+from math import gcd
+
+from executer import handlers, nop
+
+
+MAX_BLOCK_LENGTH = 64
+RECOMPILE_LIMIT = 8
+
+# The recorded results the condition codes are computed from.
+RESULT = frozenset(('flag_result',))
+CARRY = frozenset(('carry_result',))
+ALL_FLAGS = RESULT | CARRY
+
+# Results each opcode records.
+flagsWritten = {
+    0x04: ALL_FLAGS,    # ADD
+    0x05: ALL_FLAGS,    # SUB
+    0x06: ALL_FLAGS,    # INC
+    0x07: ALL_FLAGS,    # DEC
+    0x08: RESULT,       # XOR
+    0x09: RESULT,       # AND
+    0x0A: RESULT,       # OR
+    0x0B: RESULT,       # NOT
+    0x0C: ALL_FLAGS,    # SHL
+    0x0D: RESULT,       # SHR
+    0x11: ALL_FLAGS,    # CMP
+}
+
+# Source of the flag predicates in executer.jumpConditions and the results they read.
+jumpConditionSource = {
+    0x13: ('machine.flag_result == 0', RESULT),
+    0x14: ('machine.flag_result != 0', RESULT),
+    0x15: ('machine.carry_result > 65535', CARRY),
+    0x16: ('machine.carry_result <= 65535', CARRY),
+    0x17: ('machine.carry_result <= 65535 and machine.flag_result != 0', ALL_FLAGS),
+    0x18: ('machine.carry_result <= 65535', CARRY),
+    0x19: ('machine.carry_result > 65535', CARRY),
+    0x1A: ('machine.carry_result > 65535 or machine.flag_result == 0', ALL_FLAGS),
+}
+
+# Opcodes whose handler is called from the block as it is.
+# READ also ends the block since it may write into the code.
+PUSH, POP, READ, PRINT = 0x0F, 0x10, 0x1B, 0x1C
+
+# Opcodes that read a register number from the operand in every mode.
+registerOperandOnly = (0x0C, 0x0D)
+
+
+#######----- CODE GENERATION -----#######
+
+# Whether the instruction names a register that does not exist.
+# Such instructions are left to the handler so they fail the same way.
+def badRegister(opcode, mode, operand):
+    if opcode in registerOperandOnly or mode == 1 or mode == 2:
+        return operand > 5 or operand == 0
+    return False
+
+
+# Whether the instruction writes a word into the memory.
+def writesMemory(opcode, mode):
+    if opcode == 0x03:
+        return mode != 1
+    if opcode in (0x06, 0x07, 0x0B):
+        return mode >= 2
+    return False
+
+
+# Append the lines that load the operand and return its value expression.
+def operandSource(lines, mode, operand):
+    if mode == 0:
+        return str(operand)
+    if mode == 1:
+        return 'registers[%d]' % operand
+    if mode == 2:
+        lines.append('address = registers[%d]' % operand)
+        return '(memory[address] << 8 | memory[address + 1])'
+    return '(memory[%d] << 8 | memory[%d])' % (operand, operand + 1)
+
+
+# Append the lines that write tempA into the memory word of the operand.
+def writeSource(lines, mode, operand, valueSource):
+    if mode == 2:
+        lines.append('address = registers[%d]' % operand)
+    else:
+        lines.append('address = %d' % operand)
+    lines.append('value = %s' % valueSource)
+    lines.append('memory[address] = (value >> 8) & 0xFF')
+    lines.append('memory[address + 1] = value & 0xFF')
+
+
+# Append the lines that leave the block when the last write hit the code.
+# writeWord() is called again only for its cache invalidation.
+def exitOnCodeWrite(lines, count, nextAddress):
+    lines.append('if address < machine.code_end:')
+    lines.append('    machine.writeWord(address, value)')
+    lines.append('    machine.steps += %d' % count)
+    lines.append('    return %d' % nextAddress)
+
+
+# Append the recording of tempA for the condition codes that are still live.
+# Same as the handlers in executer.py: carry opcodes record both results.
+def flagSource(lines, live, carry):
+    if carry and 'carry_result' in live:
+        lines.append('machine.carry_result = tempA')
+    if 'flag_result' in live:
+        lines.append('machine.flag_result = tempA')
+
+
+# Append the source of an instruction that does not end the block.
+def instructionSource(lines, instruction, live, count, nextAddress):
+    opcode, mode, operand = instruction
+    if opcode == 0x02:  # LOAD
+        lines.append('registers[1] = %s' % operandSource(lines, mode, operand))
+    elif opcode == 0x03:  # STORE
+        if mode == 1:
+            lines.append('registers[%d] = registers[1]' % operand)
+        else:
+            writeSource(lines, mode, operand, 'registers[1]')
+            exitOnCodeWrite(lines, count, nextAddress)
+    elif opcode in (0x04, 0x05):  # ADD, SUB
+        sign = '+' if opcode == 0x04 else '-'
+        lines.append('tempA = registers[1] %s %s' % (sign, operandSource(lines, mode, operand)))
+        flagSource(lines, live, True)
+        lines.append('if tempA > 65535:')
+        lines.append('    tempA = tempA - 65535')
+        lines.append('registers[1] = tempA & 0xFFFF')
+    elif opcode == 0x11:  # CMP
+        lines.append('tempA = registers[1] - %s' % operandSource(lines, mode, operand))
+        flagSource(lines, live, True)
+    elif opcode in (0x06, 0x07, 0x0B):  # INC, DEC, NOT
+        if opcode == 0x0B:
+            template = '~%s'
+        else:
+            template = '%s + 1' if opcode == 0x06 else '%s - 1'
+        if mode == 0:
+            lines.append('tempA = ' + template % operand)
+        elif mode == 1:
+            lines.append('tempA = ' + template % ('registers[%d]' % operand))
+            lines.append('registers[%d] = tempA & 0xFFFF' % operand)
+        else:
+            lines.append('tempA = ' + template % operandSource(lines, mode, operand))
+            writeSource(lines, mode, operand, 'tempA')
+        flagSource(lines, live, opcode != 0x0B)
+        if mode >= 2:
+            exitOnCodeWrite(lines, count, nextAddress)
+    elif opcode in (0x08, 0x09, 0x0A):  # XOR, AND, OR
+        operator = {0x08: '^', 0x09: '&', 0x0A: '|'}[opcode]
+        lines.append('tempA = registers[1] %s %s' % (operator, operandSource(lines, mode, operand)))
+        flagSource(lines, live, False)
+        lines.append('registers[1] = tempA')
+    elif opcode in (0x0C, 0x0D):  # SHL, SHR
+        if mode == 1:
+            lines.append('tempA = registers[%d] %s 1' % (operand, '<<' if opcode == 0x0C else '>>'))
+        else:
+            lines.append('tempA = registers[%d]' % operand)
+        flagSource(lines, live, opcode == 0x0C)
+    elif opcode in (PUSH, POP, PRINT):
+        if opcode != PRINT and mode == 1:
+            # The stack checks report the PC of the failing instruction.
+            lines.append('machine.program_counter = %d' % ((nextAddress - 3) & 0xFFFF))
+        lines.append('handlers[%d](machine, %d, %d)' % (opcode, mode, operand))
+        if opcode == PUSH and mode == 1:
+            # The stack only reaches the code when the program was loaded above it.
+            lines.append('if machine.stack_pointer < machine.code_end:')
+            lines.append('    machine.steps += %d' % count)
+            lines.append('    return %d' % nextAddress)
+    # NOP and the undefined opcodes do nothing.
+
+
+# Append the source of the instruction that ends the block.
+def terminatorSource(lines, instruction, address, count):
+    opcode, mode, operand = instruction
+    nextAddress = (address + 3) & 0xFFFF
+    lines.append('machine.steps += %d' % count)
+    if opcode == 0x01:  # HALT
+        lines.append('machine.halted = True')
+        lines.append('machine.output.flush()')
+        lines.append('return %d' % address)
+        return
+    if opcode == READ or badRegister(opcode, mode, operand):
+        lines.append('machine.program_counter = %d' % address)
+        lines.append('if handlers[%d](machine, %d, %d):' % (opcode, mode, operand))
+        lines.append('    return machine.program_counter')
+        lines.append('return %d' % nextAddress)
+        return
+    target = operandSource(lines, mode, operand)
+    if opcode == 0x12:  # JMP
+        lines.append('return %s' % target)
+        return
+    lines.append('if %s:' % jumpConditionSource[opcode][0])
+    lines.append('    return %s' % target)
+    lines.append('return %d' % nextAddress)
+
+
+# Whether the instruction ends a block.
+def endsBlock(instruction):
+    opcode, mode, operand = instruction
+    return opcode == 0x01 or 0x12 <= opcode <= 0x1A or opcode == READ
+
+
+# Collect the instructions of the block starting at the address.
+# Returns a list of (address, instruction) pairs.
+def findBlock(machine, address):
+    block = []
+    while len(block) < MAX_BLOCK_LENGTH:
+        instruction = machine.decoded.get(address)
+        if instruction is None:
+            instruction = machine.decodeAt(address)
+        block.append((address, instruction))
+        if endsBlock(instruction):
+            break
+        address = (address + 3) & 0xFFFF
+    return block
+
+
+# Generate the Python source of the block starting at the address.
+# Returns the source and the (address, instruction) pairs of the block.
+def blockSource(machine, address):
+    block = findBlock(machine, address)
+
+    # Backward pass: which condition codes can still be read after each instruction.
+    # Everything is live at the block exits and wherever the block may return early.
+    liveAfter = [None] * len(block)
+    live = ALL_FLAGS
+    for index in range(len(block) - 1, -1, -1):
+        opcode, mode, operand = block[index][1]
+        if badRegister(opcode, mode, operand):
+            # The handler raises before it records anything.
+            liveAfter[index] = live = ALL_FLAGS
+            continue
+        if writesMemory(opcode, mode) or opcode in (PUSH, POP, PRINT):
+            live = ALL_FLAGS
+        liveAfter[index] = live
+        live = live - flagsWritten.get(opcode, frozenset())
+        if opcode in jumpConditionSource:
+            live = live | jumpConditionSource[opcode][1]
+
+    lines = ['registers = machine.registers', 'memory = machine.memory']
+    last = len(block) - 1
+    for index, (instructionAddress, instruction) in enumerate(block):
+        opcode, mode, operand = instruction
+        lines.append('# %04X: %02X %d %04X' % (instructionAddress, opcode, mode, operand))
+        if index == last and endsBlock(instruction):
+            terminatorSource(lines, instruction, instructionAddress, index + 1)
+        elif badRegister(opcode, mode, operand):
+            lines.append('machine.program_counter = %d' % instructionAddress)
+            lines.append('handlers[%d](machine, %d, %d)' % (opcode, mode, operand))
+        else:
+            nextAddress = (instructionAddress + 3) & 0xFFFF
+            instructionSource(lines, instruction, liveAfter[index], index + 1, nextAddress)
+    if not endsBlock(block[last][1]):
+        lines.append('machine.steps += %d' % len(block))
+        lines.append('return %d' % ((block[last][0] + 3) & 0xFFFF))
+
+    source = 'def block(machine, budget=None):\n' + ''.join('    %s\n' % line for line in lines)
+    return source, block
+
+
+#######----- TIGHT LOOPS -----#######
+
+INC, DEC, JMP, JNZ = 0x06, 0x07, 0x12, 0x14
+
+# Iterations a loop that never exits runs per call without a budget.
+# Every register step is a multiple of 1/65536 of a full turn, so this
+# brings the registers and the flags back to where they were.
+SPIN_ITERATIONS = 0x10000
+
+
+# A loop of NOPs and INC / DEC of registers closed by JMP or JNZ to its start.
+class TightLoop:
+    __slots__ = ('address', 'exit', 'length', 'deltas', 'counter', 'offset', 'direction', 'conditional')
+
+    def __init__(self, address, exit, length, deltas, counter, offset, direction, conditional):
+        self.address = address
+        self.exit = exit
+        self.length = length
+        # Register -> what one iteration adds to it.
+        self.deltas = deltas
+        # Register of the last INC / DEC (None without one), what the
+        # iteration added to it before that instruction and +1 or -1.
+        self.counter = counter
+        self.offset = offset
+        self.direction = direction
+        self.conditional = conditional
+
+    # Number of iterations up to and including the one after which JNZ
+    # falls through, None when the loop never exits.
+    def iterations(self, machine):
+        if not self.conditional:
+            return None
+        if self.counter is None:
+            # The flags never change in the loop.
+            return 1 if machine.flag_result == 0 else None
+        if self.direction == 1:
+            # INC records 1 to 65536, never 0.
+            return None
+        # DEC records 0 when the counter is 1 before it: solve
+        # start + i * delta = 1 (mod 65536) for the smallest i >= 0.
+        start = machine.registers[self.counter] + self.offset
+        delta = self.deltas[self.counter] % 0x10000
+        difference = (1 - start) % 0x10000
+        if delta == 0:
+            return 1 if difference == 0 else None
+        divisor = gcd(delta, 0x10000)
+        if difference % divisor:
+            return None
+        modulus = 0x10000 // divisor
+        return (difference // divisor) * pow(delta // divisor, -1, modulus) % modulus + 1
+
+    # Execute the loop in closed form, at most budget instructions of it.
+    # Returns the address of the next instruction.
+    def run(self, machine, budget=None):
+        count = self.iterations(machine)
+        exits = count is not None
+        if not exits:
+            count = SPIN_ITERATIONS
+        if budget is not None and count * self.length > budget:
+            count = budget // self.length
+            exits = False
+        if count == 0:
+            return self.address
+        registers = machine.registers
+        if self.counter is not None:
+            start = registers[self.counter] + self.offset
+            tempA = ((start + (count - 1) * self.deltas[self.counter]) & 0xFFFF) + self.direction
+            machine.flag_result = machine.carry_result = tempA
+        for register, delta in self.deltas.items():
+            registers[register] = (registers[register] + count * delta) & 0xFFFF
+        machine.steps += count * self.length
+        return self.exit if exits else self.address
+
+    # The loop as a block function.
+    def blockFunction(self):
+        def block(machine, budget=None):
+            return self.run(machine, budget)
+        return block
+
+
+# The TightLoop of the block's (address, instruction) pairs, None when the
+# block is not one.
+def findTightLoop(instructions):
+    address = instructions[0][0]
+    jumpAddress, (jump, mode, operand) = instructions[-1]
+    if jump not in (JMP, JNZ) or mode != 0 or operand != address:
+        return None
+    deltas = {}
+    counter = offset = direction = None
+    for _, (opcode, mode, operand) in instructions[:-1]:
+        if opcode in (INC, DEC) and mode == 1 and 0 < operand <= 5:
+            step = 1 if opcode == INC else -1
+            counter, offset, direction = operand, deltas.get(operand, 0), step
+            deltas[operand] = deltas.get(operand, 0) + step
+        elif handlers[opcode] is not nop:
+            return None
+    return TightLoop(address, (jumpAddress + 3) & 0xFFFF, len(instructions), deltas,
+                     counter, offset, direction, jump == JNZ)
+
+# ------------------------------------ #
+
+
+# The function of a block that is not compiled: the interpreter executes
+# its instructions, following any change to them.
+def interpretedBlock(length):
+    def block(machine, budget=None):
+        machine.run(length)
+        return machine.program_counter
+    return block
+
+
+# Compile the block starting at the address and cache it on the machine.
+# The function gets the number of its instructions, their opcodes, the
+# TightLoop when it fast-forwards a loop (None otherwise) and whether it is
+# left to the interpreter.
+def compileBlock(machine, address):
+    instructions = findBlock(machine, address)
+    loop = None
+    interpreted = machine.dropped_blocks.get(address, 0) >= RECOMPILE_LIMIT
+    if interpreted:
+        block = interpretedBlock(len(instructions))
+    else:
+        loop = findTightLoop(instructions)
+        if loop is not None:
+            block = loop.blockFunction()
+        else:
+            source, instructions = blockSource(machine, address)
+            namespace = {'handlers': handlers}
+            exec(compile(source, '<block %04X>' % address, 'exec'), namespace)
+            block = namespace['block']
+    block.loop = loop
+    block.interpreted = interpreted
+    block.length = len(instructions)
+    block.opcodes = tuple(instruction[0] for _, instruction in instructions)
+    machine.blocks[address] = block
+    pages = machine.block_pages
+    for page in range(address >> 8, ((address + 3 * block.length - 1) >> 8) + 1):
+        pages.setdefault(page & 0xFF, set()).add(address)
+    return block
+
+
+# Count the steps of a block that raised. Only the last instruction of a
+# block adds the block's steps before it runs, one failing in the middle
+# has set the PC to itself. Returns the steps of the block.
+def countFailedBlock(machine, address, before):
+    if machine.steps == before:
+        machine.steps = before + ((machine.program_counter - address) & 0xFFFF) // 3 + 1
+    return machine.steps - before
+
+# ------------------------------------ #
+
+
+# Execute compiled blocks until HALT or until max_steps instructions are executed.
+# Blocks that do not fit in the remaining steps are left to the interpreter.
+# Returns the number of instructions executed by this call.
+def run(machine, max_steps=None):
+    if machine.halted:
+        return 0
+    blocks = machine.blocks
+    start = machine.steps
+    if max_steps is None:
+        while not machine.halted:
+            address = machine.program_counter
+            block = blocks.get(address)
+            if block is None:
+                block = compileBlock(machine, address)
+            before = machine.steps
+            try:
+                machine.program_counter = block(machine)
+            except Exception:
+                countFailedBlock(machine, address, before)
+                raise
+    else:
+        while not machine.halted:
+            remaining = max_steps - (machine.steps - start)
+            if remaining <= 0:
+                break
+            address = machine.program_counter
+            block = blocks.get(address)
+            if block is None:
+                block = compileBlock(machine, address)
+            if block.length > remaining:
+                machine.run(remaining)
+                break
+            before = machine.steps
+            try:
+                machine.program_counter = block(machine, remaining)
+            except Exception:
+                countFailedBlock(machine, address, before)
+                raise
+    return machine.steps - start
@@ -0,0 +1,375 @@
+#!/usr/bin/python
+
+import json
+import sys
+
+import numpy as np
+
+from executer import MEMORY_SIZE, STACK_BOTTOM, Machine, initialFlagResult, unsignedMAX
+
+
+## Runs one program for many inputs at once: every run is a lane and the
+## lanes are executed in lockstep with NumPy.
+##
+## The state of all lanes is held in arrays: registers (N x 6), the ALU
+## results the condition codes come from, PC, stack pointer and the memory
+## as a 65538 x N uint8 array: a column per lane, so an address that is the
+## same in every lane is one contiguous row. Each turn takes the lowest PC among the
+## running lanes and executes that instruction for every lane that is at it,
+## with one vectorised operation per instruction. Lanes that take different
+## branches get different PCs and are executed separately until they meet
+## again; taking the lowest PC first lets the lanes that are behind catch up.
+##
+## The lanes compute exactly what Machine.run computes for the same program
+## and input, faults included: a lane that fails stops with the error the
+## interpreter would raise.
+##
+## Needs NumPy.
+##
+## usage: lanes.py [--max-steps N] <programfile> <inputfile>
+##
+## every line of the input file is the READ input of one lane (\n escapes a
+## line break). Prints one JSON line per lane like batch.py.
+
+
+RUNNING, HALTED, FAULT = 0, 1, 2
+statusNames = {RUNNING: 'max_steps', HALTED: 'halted', FAULT: 'fault'}
+
+# Opcodes reading a register in every mode, and the ones doing so in modes 1 and 2.
+# PUSH, POP, READ and the jumps check their register themselves, after the
+# checks the interpreter makes first.
+SHL, SHR, PUSH, POP, READ, PRINT = 0x0C, 0x0D, 0x0F, 0x10, 0x1B, 0x1C
+registerInEveryMode = (SHL, SHR)
+registerInModes12 = (0x02, 0x03, 0x04, 0x05, 0x06, 0x07, 0x08, 0x09, 0x0A, 0x0B, 0x11, PRINT)
+
+# The same predicates as executer.jumpConditions over the arrays of the lanes.
+laneConditions = {
+    0x13: lambda result, carry: result == 0,
+    0x14: lambda result, carry: result != 0,
+    0x15: lambda result, carry: carry > unsignedMAX,
+    0x16: lambda result, carry: carry <= unsignedMAX,
+    0x17: lambda result, carry: (carry <= unsignedMAX) & (result != 0),
+    0x18: lambda result, carry: carry <= unsignedMAX,
+    0x19: lambda result, carry: carry > unsignedMAX,
+    0x1A: lambda result, carry: (carry > unsignedMAX) | (result == 0),
+}
+
+
+class LaneBatch:
+    # program is anything Machine.load() accepts or the path of a program file.
+    # inputs holds the READ input of every lane (str or bytes), line breaks
+    # are skipped like the default InputStream does.
+    def __init__(self, program, inputs):
+        machine = Machine()
+        if isinstance(program, str):
+            machine.loadFile(program)
+        else:
+            machine.load(program)
+        count = len(inputs)
+        self.count = count
+        self.memory = np.empty((MEMORY_SIZE + 2, count), dtype=np.uint8)
+        self.memory[:] = np.frombuffer(bytes(machine.memory), dtype=np.uint8)[:, None]
+        # Addresses any lane wrote to: only there the lanes can have different code.
+        self.written = np.zeros(MEMORY_SIZE + 2, dtype=bool)
+        self.registers = np.zeros((count, 6), dtype=np.int64)
+        self.flag_result = np.full(count, initialFlagResult, dtype=np.int64)
+        self.carry_result = np.zeros(count, dtype=np.int64)
+        self.program_counter = np.full(count, machine.program_counter, dtype=np.int64)
+        self.stack_pointer = np.full(count, STACK_BOTTOM, dtype=np.int64)
+        self.stack_limit = machine.stack_limit
+        self.status = np.full(count, RUNNING, dtype=np.int8)
+        self.steps = np.zeros(count, dtype=np.int64)
+        self.errors = [None] * count
+        self.outputs = [[] for _ in range(count)]
+
+        encoded = [(value.encode('utf-8') if isinstance(value, str) else bytes(value))
+                   .translate(None, b'\r\n') for value in inputs]
+        self.inputLength = np.array([len(value) for value in encoded], dtype=np.int64)
+        width = max([len(value) for value in encoded] + [0]) + 1
+        self.input = np.zeros((count, width), dtype=np.int64)
+        for lane, value in enumerate(encoded):
+            self.input[lane, :len(value)] = np.frombuffer(value, dtype=np.uint8)
+        self.inputPosition = np.zeros(count, dtype=np.int64)
+
+        self.handlers = {
+            0x02: self.load, 0x03: self.store, 0x04: self.add, 0x05: self.sub,
+            0x06: self.inc, 0x07: self.dec, 0x08: self.xor, 0x09: self.andd,
+            0x0A: self.orr, 0x0B: self.nott, SHL: self.shl, SHR: self.shr,
+            PUSH: self.pushh, POP: self.popp, 0x11: self.cmp, 0x12: self.jmp,
+            READ: self.readchar, PRINT: self.printchar,
+        }
+        for opcode, condition in laneConditions.items():
+            self.handlers[opcode] = self.conditionalJump(condition)
+
+    #######----- LANE STATE -----#######
+
+    def readWord(self, lanes, address):
+        memory = self.memory
+        return memory[address, lanes].astype(np.int64) << 8 | memory[address + 1, lanes]
+
+    def writeWord(self, lanes, address, value):
+        self.memory[address, lanes] = (value >> 8) & 0xFF
+        self.memory[address + 1, lanes] = value & 0xFF
+        self.written[address] = True
+        self.written[address + 1] = True
+
+    # The operand value for the lanes, as the handlers in executer.py read it.
+    def operandValue(self, lanes, mode, operand):
+        if mode == 0:
+            return np.full(len(lanes), operand, dtype=np.int64)
+        if mode == 1:
+            return self.registers[lanes, operand]
+        if mode == 2:
+            return self.readWord(lanes, self.registers[lanes, operand])
+        return self.readWord(lanes, operand)
+
+    # Stop the lanes with the error the interpreter would raise.
+    def fault(self, lanes, error):
+        self.status[lanes] = FAULT
+        for lane in lanes.tolist():
+            self.errors[lane] = error
+
+    # ------------------------------------ #
+
+    #######----- OPCODES -----#######
+
+    def load(self, lanes, mode, operand):
+        self.registers[lanes, 1] = self.operandValue(lanes, mode, operand)
+
+    def store(self, lanes, mode, operand):
+        if mode == 1:
+            self.registers[lanes, operand] = self.registers[lanes, 1]
+        elif mode == 2:
+            self.writeWord(lanes, self.registers[lanes, operand], self.registers[lanes, 1])
+        else:
+            self.writeWord(lanes, operand, self.registers[lanes, 1])
+
+    def add(self, lanes, mode, operand):
+        self.arithmetic(lanes, self.registers[lanes, 1] + self.operandValue(lanes, mode, operand))
+
+    def sub(self, lanes, mode, operand):
+        self.arithmetic(lanes, self.registers[lanes, 1] - self.operandValue(lanes, mode, operand))
+
+    def arithmetic(self, lanes, tempA):
+        self.flag_result[lanes] = tempA
+        self.carry_result[lanes] = tempA
+        tempA = np.where(tempA > unsignedMAX, tempA - unsignedMAX, tempA)
+        self.registers[lanes, 1] = tempA & 0xFFFF
+
+    def inc(self, lanes, mode, operand):
+        self.step(lanes, mode, operand, 1)
+
+    def dec(self, lanes, mode, operand):
+        self.step(lanes, mode, operand, -1)
+
+    # INC and DEC: add the difference to the operand.
+    def step(self, lanes, mode, operand, difference):
+        if mode == 0:
+            tempA = np.full(len(lanes), operand + difference, dtype=np.int64)
+        elif mode == 1:
+            tempA = self.registers[lanes, operand] + difference
+            self.registers[lanes, operand] = tempA & 0xFFFF
+        else:
+            address = self.registers[lanes, operand] if mode == 2 else operand
+            tempA = self.readWord(lanes, address) + difference
+            self.writeWord(lanes, address, tempA)
+        self.flag_result[lanes] = tempA
+        self.carry_result[lanes] = tempA
+
+    def xor(self, lanes, mode, operand):
+        self.logic(lanes, self.registers[lanes, 1] ^ self.operandValue(lanes, mode, operand))
+
+    def andd(self, lanes, mode, operand):
+        self.logic(lanes, self.registers[lanes, 1] & self.operandValue(lanes, mode, operand))
+
+    def orr(self, lanes, mode, operand):
+        self.logic(lanes, self.registers[lanes, 1] | self.operandValue(lanes, mode, operand))
+
+    def logic(self, lanes, tempA):
+        self.flag_result[lanes] = tempA
+        self.registers[lanes, 1] = tempA
+
+    def nott(self, lanes, mode, operand):
+        if mode == 0:
+            tempA = np.full(len(lanes), ~operand, dtype=np.int64)
+        elif mode == 1:
+            tempA = ~self.registers[lanes, operand]
+            self.registers[lanes, operand] = tempA & 0xFFFF
+        else:
+            address = self.registers[lanes, operand] if mode == 2 else operand
+            tempA = ~self.readWord(lanes, address)
+            self.writeWord(lanes, address, tempA)
+        self.flag_result[lanes] = tempA
+
+    def shl(self, lanes, mode, operand):
+        tempA = self.registers[lanes, operand]
+        if mode == 1:
+            tempA = tempA << 1
+        self.flag_result[lanes] = tempA
+        self.carry_result[lanes] = tempA
+
+    def shr(self, lanes, mode, operand):
+        tempA = self.registers[lanes, operand]
+        if mode == 1:
+            tempA = tempA >> 1
+        self.flag_result[lanes] = tempA
+
+    def pushh(self, lanes, mode, operand):
+        if mode != 1:
+            return
+        stack_pointer = self.stack_pointer[lanes] - 2
+        overflow = stack_pointer < self.stack_limit
+        if overflow.any():
+            self.fault(lanes[overflow], 'StackError: stack overflow at %04X' % self.program_counter[lanes[0]])
+            lanes, stack_pointer = lanes[~overflow], stack_pointer[~overflow]
+        if operand > 5 or operand == 0:
+            self.fault(lanes, 'IndexError: list index out of range')
+            return
+        self.writeWord(lanes, stack_pointer, self.registers[lanes, operand])
+        self.stack_pointer[lanes] = stack_pointer
+
+    def popp(self, lanes, mode, operand):
+        if mode != 1:
+            return
+        stack_pointer = self.stack_pointer[lanes]
+        underflow = stack_pointer >= STACK_BOTTOM
+        if underflow.any():
+            self.fault(lanes[underflow], 'StackError: stack underflow at %04X' % self.program_counter[lanes[0]])
+            lanes, stack_pointer = lanes[~underflow], stack_pointer[~underflow]
+        if operand > 5 or operand == 0:
+            self.fault(lanes, 'IndexError: list index out of range')
+            return
+        self.registers[lanes, operand] = self.readWord(lanes, stack_pointer)
+        self.stack_pointer[lanes] = stack_pointer + 2
+
+    def cmp(self, lanes, mode, operand):
+        tempA = self.registers[lanes, 1] - self.operandValue(lanes, mode, operand)
+        self.flag_result[lanes] = tempA
+        self.carry_result[lanes] = tempA
+
+    # Jumps set the PC of the lanes themselves and return True.
+    def jmp(self, lanes, mode, operand):
+        if mode in (1, 2) and (operand > 5 or operand == 0):
+            self.fault(lanes, 'IndexError: list index out of range')
+            return True
+        self.program_counter[lanes] = self.operandValue(lanes, mode, operand)
+        return True
+
+    def conditionalJump(self, condition):
+        def handler(lanes, mode, operand):
+            taken = condition(self.flag_result[lanes], self.carry_result[lanes])
+            self.program_counter[lanes[~taken]] = (self.program_counter[lanes[~taken]] + 3) & 0xFFFF
+            if taken.any():
+                self.jmp(lanes[taken], mode, operand)
+            return True
+        return handler
+
+    def readchar(self, lanes, mode, operand):
+        position = self.inputPosition[lanes]
+        empty = position >= self.inputLength[lanes]
+        if empty.any():
+            self.fault(lanes[empty], 'EOFError: no more input for READ')
+            lanes, position = lanes[~empty], position[~empty]
+        val = self.input[lanes, position]
+        self.inputPosition[lanes] = position + 1
+        if mode in (1, 2) and (operand > 5 or operand == 0):
+            self.fault(lanes, 'IndexError: list index out of range')
+        elif mode == 1:
+            self.registers[lanes, operand] = val & 0xFFFF
+        elif mode == 2:
+            self.writeWord(lanes, self.registers[lanes, operand], val)
+        else:
+            self.writeWord(lanes, operand, val)
+
+    def printchar(self, lanes, mode, operand):
+        outputs = self.outputs
+        for lane, code in zip(lanes.tolist(), self.operandValue(lanes, mode, operand).tolist()):
+            outputs[lane].append(code)
+
+    # ------------------------------------ #
+
+    # Run the lanes until all of them halted or failed, or until every lane
+    # executed max_steps more instructions.
+    def run(self, max_steps=None):
+        limit = None if max_steps is None else self.steps + max_steps
+        memory = self.memory
+        written = self.written
+        handlers = self.handlers
+        while True:
+            running = self.status == RUNNING
+            if limit is not None:
+                running = running & (self.steps < limit)
+            running = np.flatnonzero(running)
+            if not len(running):
+                break
+            pcs = self.program_counter[running]
+            pc = int(pcs.min())
+            lanes = running[pcs == pc]
+
+            # Lanes at the same PC may have different code there when it was written to.
+            first = lanes[0]
+            if len(lanes) > 1 and written[pc:pc + 3].any():
+                code = memory[pc:pc + 3, lanes]
+                same = (code == code[:, :1]).all(axis=0)
+                if not same.all():
+                    lanes = lanes[same]
+            opcode = int(memory[pc, first]) >> 2
+            mode = int(memory[pc, first]) & 0x3
+            operand = int(memory[pc + 1, first]) << 8 | int(memory[pc + 2, first])
+            self.steps[lanes] += 1
+
+            # HALT
+            if opcode == 0x01:
+                self.status[lanes] = HALTED
+                continue
+            handler = handlers.get(opcode)
+            if handler is None:
+                self.program_counter[lanes] = (pc + 3) & 0xFFFF
+                continue
+            if (operand > 5 or operand == 0) and (opcode in registerInEveryMode or
+                                              (mode in (1, 2) and opcode in registerInModes12)):
+                self.fault(lanes, 'IndexError: list index out of range')
+                continue
+            if handler(lanes, mode, operand):
+                continue
+            lanes = lanes[self.status[lanes] == RUNNING]
+            self.program_counter[lanes] = (pc + 3) & 0xFFFF
+
+    # Condition codes of a lane, as Machine.zf, Machine.cf and Machine.sf.
+    def flags(self, lane):
+        result = int(self.flag_result[lane])
+        carry = int(self.carry_result[lane])
+        return (1 if result == 0 else 0, 1 if carry > unsignedMAX else 0,
+                1 if result <= 2 * unsignedMAX else 0)
+
+    # PRINT output of a lane, as the default output device writes it.
+    def output(self, lane):
+        return ''.join(chr(code) + '\n' for code in self.outputs[lane])
+
+    # Result dict of a lane, like batch.py reports it.
+    def result(self, lane):
+        result = {'lane': lane, 'status': statusNames[int(self.status[lane])]}
+        if self.errors[lane] is not None:
+            result['error'] = self.errors[lane]
+        result['steps'] = int(self.steps[lane])
+        result['output'] = self.output(lane)
+        result['registers'] = dict(zip('ABCDE', self.registers[lane, 1:].tolist()))
+        return result
+
+
+def main(argv):
+    maxSteps = None
+    if len(argv) > 2 and argv[1] == '--max-steps':
+        maxSteps = int(argv[2])
+        argv = argv[:1] + argv[3:]
+    if len(argv) != 3: print('usage: lanes.py [--max-steps N] <programfile> <inputfile>'); sys.exit(1)
+    with open(argv[2], 'r') as f:
+        inputs = [line.rstrip('\n').replace('\\n', '\n') for line in f]
+    batch = LaneBatch(argv[1], inputs)
+    batch.run(maxSteps)
+    for lane in range(batch.count):
+        sys.stdout.write(json.dumps(batch.result(lane)) + '\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv)
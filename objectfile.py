@@ -0,0 +1,117 @@
+#!/usr/bin/python
+
+import mmap
+import struct
+
+
+## Assembled programs, and the binary object format written by
+## `assembler.py --binary` and read by the executer.
+##
+## Instead of one hexadecimal text line per instruction the code is stored as
+## packed 3-byte big-endian instructions, exactly as it is laid out in the
+## memory of the machine, so it can be copied into the memory as it is.
+##
+##   offset  size  field
+##   0       4     magic b'C230'
+##   4       1     format version
+##   5       1     reserved (0)
+##   6       2     entry point (address of the first instruction to execute)
+##   8       2     code size in bytes (3 * number of instructions)
+##   10      2     data segment start address
+##   12      2     data segment end address (exclusive)
+##   14      2     number of symbols
+##   16      ...   code
+##   ...     ...   symbols: 2-byte address, 1-byte name length, name (ascii)
+##
+## All the numbers are unsigned and big-endian like the instructions.
+
+
+MAGIC = b'C230'
+VERSION = 1
+
+header = struct.Struct('>4sBBHHHHH')
+symbolHeader = struct.Struct('>HB')
+
+
+# Whether the file starts with the object file magic.
+def isObjectFile(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+# Write an object file.
+# code is the packed instructions (bytes), symbols maps label names to addresses.
+def writeObject(path, code, symbols=None, entry=0, dataStart=None, dataEnd=None):
+    symbols = symbols or {}
+    if dataStart is None:
+        dataStart = len(code)
+    if dataEnd is None:
+        dataEnd = dataStart
+    with open(path, 'wb') as f:
+        f.write(header.pack(MAGIC, VERSION, 0, entry, len(code), dataStart, dataEnd, len(symbols)))
+        f.write(code)
+        for name, address in symbols.items():
+            encoded = name.encode('ascii')
+            f.write(symbolHeader.pack(address, len(encoded)))
+            f.write(encoded)
+
+
+# An assembled program held in memory.
+# code is the packed 3-byte instructions and symbols maps label names to addresses.
+class Program:
+    __slots__ = ('code', 'symbols', 'entry', 'data_start', 'data_end')
+
+    def __init__(self, code, symbols=None, entry=0, dataStart=None, dataEnd=None):
+        self.code = bytes(code)
+        self.symbols = symbols or {}
+        self.entry = entry
+        self.data_start = len(self.code) if dataStart is None else dataStart
+        self.data_end = self.data_start if dataEnd is None else dataEnd
+
+    # The instructions as 24-bit integers.
+    def instructions(self):
+        code = self.code
+        return [code[index] << 16 | code[index + 1] << 8 | code[index + 2]
+                for index in range(0, len(code), 3)]
+
+    def writeObject(self, path):
+        writeObject(path, self.code, self.symbols, self.entry, self.data_start, self.data_end)
+
+
+# A memory mapped object file.
+# code is a memoryview on the mapped file, nothing is copied until the
+# machine loads it. Close the object (or use it in a with statement) once the
+# program is loaded.
+class ObjectFile:
+    __slots__ = ('entry', 'data_start', 'data_end', 'symbols', 'code', '_file', '_map')
+
+    def __init__(self, path):
+        self.code = None
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, self.entry, codeSize, self.data_start, self.data_end, count = \
+            header.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError('%s is not a CPU230 object file' % path)
+        self.code = memoryview(self._map)[header.size:header.size + codeSize]
+        self.symbols = {}
+        offset = header.size + codeSize
+        for _ in range(count):
+            address, length = symbolHeader.unpack_from(self._map, offset)
+            offset = offset + symbolHeader.size
+            self.symbols[bytes(self._map[offset:offset + length]).decode('ascii')] = address
+            offset = offset + length
+
+    def close(self):
+        if self.code is not None:
+            self.code.release()
+            self.code = None
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,221 @@
+#!/usr/bin/python
+
+import hashlib
+import json
+import os
+import re
+import sys
+
+
+## Preprocessor for CPU230 sources: includes, macros and constants.
+##
+##   INCLUDE routines.asm      the lines of the file, relative to the includer
+##   SIZE EQU 0010             SIZE in an operand is replaced by 0010
+##   MACRO COPY FROM, TO       a macro with parameters, up to ENDM
+##       LOAD FROM
+##       STORE TO
+##   ENDM
+##   COPY [B], C               expands to LOAD [B] / STORE C
+##
+## Labels ending in @ inside a macro (e.g. LOOP@:) get a number appended
+## that is different for every expansion, so a macro can be used twice.
+##
+## The expansion of every file is cached on disk, keyed by the hash of its
+## content and of the macros and constants defined before it. A rebuild
+## only expands the files that changed and the files including them.
+##
+## usage: preprocessor.py <sourcefile> [cache directory]
+##
+## writes the expanded source to stdout.
+
+
+CACHE_VERSION = 1
+
+# Nested macro calls deeper than this are reported as recursive.
+MAX_MACRO_DEPTH = 64
+
+# Names in an operand, character literals are left alone.
+namePattern = re.compile(r"'[^']*'|[A-Za-z_][A-Za-z0-9_@]*")
+
+
+def contentHash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+# Replace the names found in the mapping.
+def substitute(text, mapping):
+    if not mapping:
+        return text
+    return namePattern.sub(lambda match: mapping.get(match.group(), match.group()), text)
+
+
+class Preprocessor:
+    def __init__(self, cacheDirectory=None):
+        self.cacheDirectory = cacheDirectory
+        # name -> (parameter names, body lines)
+        self.macros = {}
+        # name -> replacement text
+        self.constants = {}
+        # Number of macro expansions so far, for the @ labels.
+        self.expansions = 0
+        # Files being included, to report include cycles.
+        self.including = []
+        # path -> [path, content hash] of every file it includes, directly or not.
+        self.depends = {}
+
+    # Hash of the definitions that change how the following lines expand.
+    def environmentHash(self):
+        state = json.dumps([sorted(self.macros.items()), sorted(self.constants.items()),
+                            self.expansions])
+        return contentHash(state.encode('utf-8'))
+
+    # Expand a source file. Returns the expanded lines (stripped).
+    def processFile(self, path):
+        path = os.path.abspath(path)
+        if path in self.including:
+            raise ValueError('%s includes itself' % path)
+        with open(path, 'rb') as f:
+            data = f.read()
+        key = contentHash((contentHash(data) + self.environmentHash()).encode('ascii'))
+        cached = self.readCache(key)
+        if cached is not None:
+            self.depends[path] = cached['depends']
+            self.macros = {name: (params, body) for name, (params, body) in cached['macros'].items()}
+            self.constants = cached['constants']
+            self.expansions = cached['expansions']
+            return cached['lines']
+
+        self.including.append(path)
+        depends = []
+        try:
+            lines = self.processLines(data.decode('utf-8').splitlines(), path, depends)
+        finally:
+            self.including.pop()
+        self.depends[path] = depends
+        self.writeCache(key, {
+            'lines': lines,
+            'macros': self.macros,
+            'constants': self.constants,
+            'expansions': self.expansions,
+            'depends': depends,
+        })
+        return lines
+
+    # Expand the lines of a file, the included files are added to depends
+    # as [path, content hash] pairs.
+    def processLines(self, source, path, depends):
+        output = []
+        macro = None
+        for number, line in enumerate(source, 1):
+            line = line.strip()
+            words = line.split(None, 2)
+            where = '%s:%d' % (path, number)
+            if macro is not None:
+                if words and words[0] == 'ENDM':
+                    self.macros[macro[0]] = (macro[1], macro[2])
+                    macro = None
+                else:
+                    macro[2].append(line)
+                continue
+            if not words:
+                continue
+            if words[0] == 'MACRO':
+                if len(words) < 2:
+                    raise ValueError('%s: MACRO without a name' % where)
+                rest = line.split(None, 1)[1]
+                name, _, params = rest.partition(' ')
+                macro = (name, [param.strip() for param in params.split(',') if param.strip()], [])
+            elif words[0] == 'INCLUDE':
+                if len(words) < 2:
+                    raise ValueError('%s: INCLUDE without a file' % where)
+                includePath = os.path.join(os.path.dirname(path), line.split(None, 1)[1].strip())
+                output.extend(self.processFile(includePath))
+                includePath = os.path.abspath(includePath)
+                depends.append([includePath, self.fileHash(includePath)])
+                depends.extend(self.depends[includePath])
+            elif len(words) == 3 and words[1] == 'EQU':
+                self.constants[words[0]] = substitute(words[2].strip(), self.constants)
+            else:
+                self.expandLine(line, output, where, 0)
+        if macro is not None:
+            raise ValueError('%s: MACRO %s without ENDM' % (path, macro[0]))
+        return output
+
+    # Expand one line: a macro call or an instruction whose operand may use constants.
+    def expandLine(self, line, output, where, depth):
+        instruction = line.split(None, 1)
+        name = instruction[0]
+        if name in self.macros:
+            if depth >= MAX_MACRO_DEPTH:
+                raise ValueError('%s: macro %s calls itself' % (where, name))
+            params, body = self.macros[name]
+            arguments = [argument.strip() for argument in instruction[1].split(',')] \
+                if len(instruction) > 1 else []
+            if len(arguments) != len(params):
+                raise ValueError('%s: macro %s takes %d arguments' % (where, name, len(params)))
+            self.expansions = self.expansions + 1
+            suffix = '_%d' % self.expansions
+            mapping = dict(zip(params, arguments))
+            for bodyLine in body:
+                bodyLine = substitute(bodyLine, mapping)
+                bodyLine = re.sub(r'@(?=:|$|\])', suffix, bodyLine)
+                if bodyLine:
+                    self.expandLine(bodyLine, output, where, depth + 1)
+            return
+        if len(instruction) > 1:
+            line = '%s %s' % (name, substitute(instruction[1].strip(), self.constants))
+        output.append(line)
+
+    def fileHash(self, path):
+        with open(path, 'rb') as f:
+            return contentHash(f.read())
+
+    #######----- CACHE -----#######
+
+    # Return the cached expansion, None when it is missing or one of the
+    # files it includes has changed.
+    def readCache(self, key):
+        if self.cacheDirectory is None:
+            return None
+        try:
+            with open(os.path.join(self.cacheDirectory, key + '.json'), 'r') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if cached.get('version') != CACHE_VERSION:
+            return None
+        for dependPath, dependHash in cached['depends']:
+            try:
+                if self.fileHash(dependPath) != dependHash:
+                    return None
+            except OSError:
+                return None
+        return cached
+
+    def writeCache(self, key, entry):
+        if self.cacheDirectory is None:
+            return
+        entry['version'] = CACHE_VERSION
+        os.makedirs(self.cacheDirectory, exist_ok=True)
+        # Write and rename so a reader never sees half a file.
+        path = os.path.join(self.cacheDirectory, key + '.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(entry, f)
+        os.replace(path + '.tmp', path)
+
+# ------------------------------------ #
+
+
+# Expand a source file. Returns the stripped lines for assemble().
+def preprocessFile(path, cacheDirectory=None):
+    return Preprocessor(cacheDirectory).processFile(path)
+
+
+def main(argv):
+    if len(argv) not in (2, 3): print('usage: preprocessor.py <sourcefile> [cache directory]'); sys.exit(1)
+    for line in preprocessFile(argv[1], argv[2] if len(argv) == 3 else None):
+        sys.stdout.write(line + '\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv)
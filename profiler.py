@@ -0,0 +1,230 @@
+#!/usr/bin/python
+
+import bisect
+import os
+import sys
+import time
+
+from assembler import assembleFile, opCodeNumbers
+from executer import MEMORY_SIZE, Machine, handlers
+from objectfile import ObjectFile, isObjectFile
+
+
+## Instruction level profiler for CPU230 programs.
+##
+## profile() runs the machine in its own copy of the main loop that counts
+## how often every address and every opcode is executed and how much wall
+## time each opcode's handler takes. Machine.run is left as it is, so
+## there is no cost when the profiler is not used.
+##
+## usage: profiler.py <programfile> [output prefix]
+##
+## - <prefix>.prof.txt: hot spots by address and by opcode, with the labels
+##   and, for .asm sources, the source lines.
+## - <prefix>.folded: collapsed stacks (program;label;instruction count)
+##   for flamegraph.pl and compatible viewers.
+##
+## The prefix defaults to the program file name without its extension.
+
+
+# Opcode names for the report, the first name of opcodes with aliases (JZ, not JE).
+opcodeNames = {}
+for name, number in opCodeNumbers.items():
+    opcodeNames.setdefault(number, name)
+opcodeNames[0] = 'UNDEFINED'
+
+modeFormats = ('%04X', '%s', '[%s]', '[%04X]')
+registerNames = ' ABCDE'
+
+# Rows of the address table in the text report.
+TOP_ADDRESSES = 30
+
+
+# Counters collected by profile().
+# handlerTime is in nanoseconds, elapsed in seconds.
+class Profile:
+    __slots__ = ('addresses', 'opcodes', 'handlerTime', 'elapsed', 'steps')
+
+    def __init__(self):
+        self.addresses = [0] * MEMORY_SIZE
+        self.opcodes = [0] * 64
+        self.handlerTime = [0] * 64
+        self.elapsed = 0.0
+        self.steps = 0
+
+
+# Same as Machine.run, counting every executed instruction into the profile.
+# Returns the profile, a new one unless one is given to add to.
+def profile(machine, max_steps=None, result=None):
+    result = Profile() if result is None else result
+    if machine.halted:
+        return result
+    decoded = machine.decoded
+    addresses = result.addresses
+    opcodes = result.opcodes
+    handlerTime = result.handlerTime
+    clock = time.perf_counter_ns
+    limit = -1 if max_steps is None else max_steps
+    steps = 0
+    start = time.perf_counter()
+    try:
+        while steps != limit:
+            program_counter = machine.program_counter
+            try:
+                instruction = decoded[program_counter]
+            except KeyError:
+                instruction = machine.decodeAt(program_counter)
+            opcode, modeInt, operandInt = instruction
+            steps = steps + 1
+            addresses[program_counter] += 1
+            opcodes[opcode] += 1
+            # HALT
+            if opcode == 0x01:
+                machine.halted = True
+                machine.output.flush()
+                break
+            handlerStart = clock()
+            jumped = handlers[opcode](machine, modeInt, operandInt)
+            handlerTime[opcode] += clock() - handlerStart
+            if jumped:
+                continue
+            machine.program_counter = (program_counter + 3) & 0xFFFF
+    finally:
+        machine.steps = machine.steps + steps
+        result.steps = result.steps + steps
+        result.elapsed = result.elapsed + time.perf_counter() - start
+    return result
+
+
+# Disassemble one decoded instruction, e.g. 'STORE [B]'.
+def disassemble(instruction, symbols=None):
+    opcode, mode, operand = instruction
+    name = opcodeNames.get(opcode, opcodeNames[0])
+    if opcode == 0x01 or opcode == 0x0E or opcode not in opcodeNames:
+        return name
+    if mode in (1, 2):
+        value = registerNames[operand] if 0 < operand < len(registerNames) else '?%d' % operand
+    else:
+        value = operand
+    if mode == 0 and symbols and operand in symbols and (0x12 <= opcode <= 0x1A or opcode == 0x02):
+        return '%s %s' % (name, symbols[operand])
+    return '%s %s' % (name, modeFormats[mode] % value)
+
+
+# The label an address belongs to, the closest one at or before it.
+# labelStarts is a sorted list of (address, name) pairs.
+def labelOf(address, labelStarts):
+    index = bisect.bisect_right(labelStarts, (address, chr(0x10FFFF)))
+    return labelStarts[index - 1][1] if index else None
+
+
+# Where the program is: the addresses the labels point to, the source
+# line of every instruction address and the source text (None without a source).
+class SourceMap:
+    __slots__ = ('labels', 'lines', 'source', 'labelStarts')
+
+    def __init__(self, labels=None, lines=None, source=None):
+        self.labels = labels or {}
+        self.lines = lines or {}
+        self.source = source
+        self.labelStarts = sorted((address, name) for name, address in self.labels.items())
+
+    # Label and offset of the address, e.g. 'LOOP1+6'.
+    def location(self, address):
+        label = labelOf(address, self.labelStarts)
+        if label is None:
+            return '%04X' % address
+        offset = address - self.labels[label]
+        return label if offset == 0 else '%s+%d' % (label, offset)
+
+    # Source line of the address as 'number: text', '' when it is unknown.
+    def sourceLine(self, address):
+        number = self.lines.get(address)
+        if number is None or self.source is None:
+            return ''
+        return '%d: %s' % (number, self.source[number - 1].strip())
+
+
+# Load the program file into the machine and return its SourceMap.
+# .asm files are assembled, object files bring their symbols.
+def loadProgram(machine, path):
+    if path.endswith('.asm'):
+        lineNumbers = []
+        program = assembleFile(path, lineNumbers)
+        machine.load(program)
+        with open(path, 'r') as f:
+            source = f.read().splitlines()
+        lines = {index * 3: number for index, number in enumerate(lineNumbers)}
+        return SourceMap(program.symbols, lines, source)
+    if isObjectFile(path):
+        with ObjectFile(path) as program:
+            machine.load(program)
+            return SourceMap(dict(program.symbols))
+    machine.loadFile(path)
+    return SourceMap()
+
+
+# Text report: totals, the hottest addresses and every executed opcode.
+def writeReport(result, machine, sourceMap, path, top=TOP_ADDRESSES):
+    symbols = {address: name for name, address in sourceMap.labels.items()}
+    steps = result.steps or 1
+    with open(path, 'w') as f:
+        f.write('steps: %d\n' % result.steps)
+        f.write('wall time: %.6fs (%.0f instructions/sec)\n'
+                % (result.elapsed, result.steps / result.elapsed if result.elapsed else 0))
+        f.write('\nhot addresses\n')
+        f.write('%6s %12s %7s  %-16s %-20s %s\n' % ('addr', 'count', '%', 'location', 'instruction', 'source'))
+        hot = sorted((address for address in range(MEMORY_SIZE) if result.addresses[address]),
+                     key=lambda address: -result.addresses[address])
+        for address in hot[:top]:
+            instruction = machine.decoded.get(address) or machine.decodeAt(address)
+            count = result.addresses[address]
+            f.write('%6s %12d %6.2f%%  %-16s %-20s %s\n'
+                    % ('%04X' % address, count, 100.0 * count / steps, sourceMap.location(address),
+                       disassemble(instruction, symbols), sourceMap.sourceLine(address)))
+        f.write('\nopcodes\n')
+        f.write('%-10s %12s %7s %14s %10s\n' % ('opcode', 'count', '%', 'handler ns', 'ns/exec'))
+        for opcode in sorted(range(64), key=lambda opcode: -result.opcodes[opcode]):
+            count = result.opcodes[opcode]
+            if not count:
+                break
+            total = result.handlerTime[opcode]
+            f.write('%-10s %12d %6.2f%% %14d %10.1f\n'
+                    % (opcodeNames.get(opcode, '%02X' % opcode), count, 100.0 * count / steps,
+                       total, float(total) / count))
+
+
+# Collapsed stacks for flamegraphs: one line per executed address,
+# program;label;instruction followed by its execution count.
+def writeFolded(result, machine, sourceMap, path, root='program'):
+    symbols = {address: name for name, address in sourceMap.labels.items()}
+    with open(path, 'w') as f:
+        for address in range(MEMORY_SIZE):
+            count = result.addresses[address]
+            if not count:
+                continue
+            instruction = machine.decoded.get(address) or machine.decodeAt(address)
+            frames = [root]
+            label = labelOf(address, sourceMap.labelStarts)
+            if label is not None:
+                frames.append(label)
+            frames.append('%04X %s' % (address, disassemble(instruction, symbols)))
+            f.write('%s %d\n' % (';'.join(frame.replace(';', ':') for frame in frames), count))
+
+
+def main(argv):
+    if len(argv) not in (2, 3): print('usage: profiler.py <programfile> [output prefix]'); sys.exit(1)
+    prefix = argv[2] if len(argv) == 3 else os.path.splitext(argv[1])[0]
+    machine = Machine()
+    sourceMap = loadProgram(machine, argv[1])
+    try:
+        result = profile(machine)
+    finally:
+        machine.output.flush()
+    writeReport(result, machine, sourceMap, prefix + '.prof.txt')
+    writeFolded(result, machine, sourceMap, prefix + '.folded', os.path.basename(argv[1]))
+    sys.stderr.write('profile written to %s.prof.txt and %s.folded\n' % (prefix, prefix))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,145 @@
+#!/usr/bin/python
+
+import asyncio
+import sys
+
+from devices import InputStream, OutputBuffer
+from executer import Machine
+from objectfile import Program
+
+
+## Runs many CPU230 machines as asyncio tasks on one event loop.
+##
+## - runAsync() executes a slice of instructions and then lets the other
+##   tasks run, so a busy program cannot starve the rest.
+## - READ with no buffered input suspends the task until more input is fed
+##   into its AsyncInput, a waiting session costs nothing but its memory.
+##
+##   machine = Machine(AsyncInput(), OutputBuffer(writer))
+##   machine.load(program)
+##   await runAsync(machine)
+##
+## usage: sessions.py [--jit] <programfile> [port]
+##
+## serves the program over TCP: every connection gets its own machine, READ
+## reads from the connection and PRINT writes to it.
+
+
+# Instructions executed per scheduling turn.
+SLICE_STEPS = 1000
+
+DEFAULT_PORT = 2300
+
+
+# Raised by AsyncInput when READ needs input that has not arrived yet.
+class InputPending(Exception):
+    pass
+
+
+# Input device fed by coroutines.
+# READ raises InputPending instead of blocking when the buffer is empty,
+# runAsync() then waits for feed() or close() and executes the READ again.
+class AsyncInput(InputStream):
+    __slots__ = ('ready',)
+
+    def __init__(self, skipNewlines=True):
+        InputStream.__init__(self, b'', skipNewlines)
+        self.eof = False
+        self.ready = asyncio.Event()
+
+    # Append input for READ.
+    def feed(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.buffer = self.buffer[self.position:] + data
+        self.position = 0
+        self.ready.set()
+
+    # No more input will come, a READ after the buffered input raises EOFError.
+    def close(self):
+        self.eof = True
+        self.ready.set()
+
+    def refill(self):
+        if self.eof:
+            return False
+        raise InputPending()
+
+    # Wait until there is buffered input or the input is closed.
+    async def wait(self):
+        while not self.available() and not self.eof:
+            self.ready.clear()
+            await self.ready.wait()
+
+    # Feed everything read from an asyncio StreamReader, then close.
+    async def pump(self, reader, chunkSize=1 << 12):
+        try:
+            while True:
+                data = await reader.read(chunkSize)
+                if not data:
+                    break
+                self.feed(data)
+        finally:
+            self.close()
+
+
+# Run the machine until HALT, yielding to the event loop after every slice
+# and while READ waits for input.
+# run is Machine.run or jit.run. Returns the number of executed instructions.
+async def runAsync(machine, run=Machine.run, sliceSteps=SLICE_STEPS):
+    start = machine.steps
+    while not machine.halted:
+        try:
+            run(machine, sliceSteps)
+        except InputPending:
+            # The READ is executed again once the input is there, so it is
+            # not counted now. The PC still points to it.
+            machine.steps = machine.steps - 1
+            machine.output.flush()
+            await machine.input.wait()
+            continue
+        await asyncio.sleep(0)
+    return machine.steps - start
+
+
+# Serve one connection with a fresh machine running the program.
+async def serveSession(program, run, reader, writer):
+    machine = Machine(AsyncInput(), OutputBuffer(writer))
+    machine.load(program)
+    pump = asyncio.ensure_future(machine.input.pump(reader))
+    try:
+        await runAsync(machine, run)
+        await writer.drain()
+    except (EOFError, ConnectionError):
+        pass
+    finally:
+        pump.cancel()
+        writer.close()
+
+
+async def serve(program, run, port):
+    server = await asyncio.start_server(
+        lambda reader, writer: serveSession(program, run, reader, writer), port=port)
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv):
+    useJit = '--jit' in argv[1:]
+    argv = [arg for arg in argv if arg != '--jit']
+    if len(argv) not in (2, 3): print('usage: sessions.py [--jit] <programfile> [port]'); sys.exit(1)
+    # Load once, every session copies the code from this machine's memory.
+    loaded = Machine()
+    loaded.loadFile(argv[1])
+    program = Program(loaded.memory[:loaded.code_end], entry=loaded.program_counter)
+    if useJit:
+        import jit
+        run = jit.run
+    else:
+        run = Machine.run
+    port = int(argv[2]) if len(argv) == 3 else DEFAULT_PORT
+    asyncio.run(serve(program, run, port))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
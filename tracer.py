@@ -0,0 +1,237 @@
+#!/usr/bin/python
+
+import array
+import signal
+import struct
+import sys
+
+from executer import Machine, handlers, unsignedMAX
+from profiler import disassemble, loadProgram
+
+
+## Execution tracing into a fixed size ring buffer.
+##
+## trace() runs the machine in its own copy of the main loop. Before every
+## instruction it records (pc, opcode, mode, operand, A, flags) into a
+## preallocated array, overwriting the oldest records once the ring is full.
+## The ring is dumped as text when the machine halts, when an instruction
+## fails and, after a signal, the next time the ring wraps around.
+##
+## With a stream file every full ring is also appended to a binary trace
+## file, which decodeTrace() reads back.
+##
+## usage: tracer.py [--capacity N] [--stream tracefile] <programfile>
+##        tracer.py --decode <tracefile>
+##
+## Trace file: header b'C23T', version, record size, then the records.
+## A record is four little-endian 16-bit words:
+##   pc, opcode << 10 | mode << 8 | flags, operand, A
+## flags holds ZF in bit 0, CF in bit 1 and SF in bit 2.
+
+
+MAGIC = b'C23T'
+VERSION = 1
+RECORD_SIZE = 8
+header = struct.Struct('>4sBB')
+
+DEFAULT_CAPACITY = 1 << 10
+
+ZF, CF, SF = 1, 2, 4
+
+
+# Condition code bits from the recorded ALU results, as Machine.zf/cf/sf compute them.
+# SF is set unless the result is still above unsignedMAX after the carry
+# adjustment, i.e. unless it is above 2 * unsignedMAX. trace() inlines this.
+def flagBits(flag_result, carry_result):
+    return ((flag_result == 0) | (carry_result > unsignedMAX) << 1
+            | (flag_result <= 2 * unsignedMAX) << 2)
+
+
+# One decoded record as text.
+def formatRecord(record):
+    pc, opcode, mode, operand, a, flags = record
+    return '%04X  %-20s A=%04X %s%s%s' % (pc, disassemble((opcode, mode, operand)), a,
+                                          'Z' if flags & ZF else '-', 'C' if flags & CF else '-',
+                                          'S' if flags & SF else '-')
+
+
+# The ring buffer and where it goes.
+class Tracer:
+    __slots__ = ('capacity', 'records', 'index', 'total', 'stream', 'dumpFile', 'dumpRequested')
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, stream=None, dumpFile=None):
+        self.capacity = capacity
+        self.records = array.array('H', bytes(capacity * RECORD_SIZE))
+        # Next record to write (in array items, 4 per record).
+        self.index = 0
+        # Records written since the start, including the overwritten ones.
+        self.total = 0
+        self.stream = stream
+        if stream is not None:
+            stream.write(header.pack(MAGIC, VERSION, RECORD_SIZE))
+        self.dumpFile = dumpFile
+        self.dumpRequested = False
+
+    # Called by trace() whenever the ring is full.
+    def wrapped(self):
+        self.total = self.total + self.capacity
+        self.index = 0
+        if self.stream is not None:
+            writeRecords(self.stream, self.records)
+        if self.dumpRequested:
+            self.dumpRequested = False
+            self.dump()
+
+    # Write the records still in the ring to the stream, at the end of the trace.
+    def finish(self):
+        if self.stream is not None:
+            writeRecords(self.stream, self.records[:self.index])
+            self.stream.flush()
+
+    # The records in the ring from the oldest to the newest.
+    def entries(self):
+        records = self.records
+        filled = self.total > 0
+        order = list(range(self.index, len(records), 4)) if filled else []
+        order.extend(range(0, self.index, 4))
+        for item in order:
+            word = records[item + 1]
+            yield (records[item], word >> 10, (word >> 8) & 0x3, records[item + 2],
+                   records[item + 3], word & 0xFF)
+
+    # Write the ring as text, oldest record first.
+    def dump(self, f=None):
+        f = f or self.dumpFile or sys.stderr
+        count = self.total + self.index // 4
+        kept = min(count, self.capacity)
+        f.write('trace: last %d of %d instructions\n' % (kept, count))
+        for record in self.entries():
+            f.write(formatRecord(record) + '\n')
+        f.flush()
+
+    # Dump the ring the next time it wraps after the signal.
+    def installSignal(self, signum=signal.SIGUSR1):
+        def handler(signum, frame):
+            self.dumpRequested = True
+        signal.signal(signum, handler)
+
+
+# Append records to a binary trace file, always little-endian.
+def writeRecords(stream, records):
+    if sys.byteorder == 'big':
+        records = array.array('H', records)
+        records.byteswap()
+    stream.write(records.tobytes())
+
+
+# Same as Machine.run, recording every instruction into the tracer.
+# The ring is dumped at HALT and when an instruction fails.
+# Returns the number of instructions executed by this call.
+def trace(machine, tracer, max_steps=None):
+    if machine.halted:
+        return 0
+    decoded = machine.decoded
+    registers = machine.registers
+    records = tracer.records
+    end = len(records)
+    index = tracer.index
+    limit = -1 if max_steps is None else max_steps
+    steps = 0
+    try:
+        while steps != limit:
+            program_counter = machine.program_counter
+            try:
+                instruction = decoded[program_counter]
+            except KeyError:
+                instruction = machine.decodeAt(program_counter)
+            opcode, modeInt, operandInt = instruction
+            steps = steps + 1
+            records[index] = program_counter
+            flag_result = machine.flag_result
+            records[index + 1] = (opcode << 10 | modeInt << 8 | (flag_result == 0)
+                                  | (machine.carry_result > 65535) << 1 | (flag_result <= 131070) << 2)
+            records[index + 2] = operandInt
+            records[index + 3] = registers[1]
+            index = index + 4
+            if index == end:
+                tracer.wrapped()
+                index = 0
+            # HALT
+            if opcode == 0x01:
+                machine.halted = True
+                machine.output.flush()
+                break
+            if handlers[opcode](machine, modeInt, operandInt):
+                continue
+            machine.program_counter = (program_counter + 3) & 0xFFFF
+    except Exception:
+        tracer.index = index
+        machine.output.flush()
+        tracer.dump()
+        raise
+    finally:
+        tracer.index = index
+        machine.steps = machine.steps + steps
+    if machine.halted:
+        tracer.dump()
+    return steps
+
+
+# Read a binary trace file.
+# Yields (pc, opcode, mode, operand, A, flags) tuples in execution order.
+def decodeTrace(path, chunkRecords=1 << 14):
+    with open(path, 'rb') as f:
+        magic, version, recordSize = header.unpack(f.read(header.size))
+        if magic != MAGIC or version != VERSION or recordSize != RECORD_SIZE:
+            raise ValueError('%s is not a CPU230 trace file' % path)
+        while True:
+            data = f.read(chunkRecords * RECORD_SIZE)
+            if not data:
+                break
+            records = array.array('H', data)
+            if sys.byteorder == 'big':
+                records.byteswap()
+            for item in range(0, len(records), 4):
+                word = records[item + 1]
+                yield (records[item], word >> 10, (word >> 8) & 0x3, records[item + 2],
+                       records[item + 3], word & 0xFF)
+
+
+def main(argv):
+    if len(argv) == 3 and argv[1] == '--decode':
+        for record in decodeTrace(argv[2]):
+            sys.stdout.write(formatRecord(record) + '\n')
+        return
+    capacity = DEFAULT_CAPACITY
+    streamPath = None
+    arguments = []
+    index = 1
+    while index < len(argv):
+        if argv[index] == '--capacity' and index + 1 < len(argv):
+            capacity = int(argv[index + 1])
+            index = index + 2
+        elif argv[index] == '--stream' and index + 1 < len(argv):
+            streamPath = argv[index + 1]
+            index = index + 2
+        else:
+            arguments.append(argv[index])
+            index = index + 1
+    if len(arguments) != 1:
+        print('usage: tracer.py [--capacity N] [--stream tracefile] <programfile>')
+        print('       tracer.py --decode <tracefile>')
+        sys.exit(1)
+    machine = Machine()
+    loadProgram(machine, arguments[0])
+    stream = open(streamPath, 'wb') if streamPath else None
+    tracer = Tracer(capacity, stream)
+    tracer.installSignal()
+    try:
+        trace(machine, tracer)
+    finally:
+        tracer.finish()
+        if stream is not None:
+            stream.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
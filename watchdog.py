@@ -0,0 +1,267 @@
+#!/usr/bin/python
+
+import sys
+import time
+
+from assembler import opCodeNumbers
+from executer import Machine, handlers
+from jit import compileBlock, countFailedBlock
+
+
+## Runs untrusted programs with an instruction budget, a cycle budget and a
+## wall clock limit, and reports how the run ended.
+##
+## Every opcode costs a number of cycles (1 unless configured). By default
+## the program runs as compiled blocks (see jit.py) and the budgets are only
+## checked between blocks: a block runs when all of its instructions fit in
+## what is left, its cycles are a precomputed sum. A tight loop the block
+## compiler fast-forwards runs as many iterations as the budgets allow in
+## one go. The clock is read once every TIME_CHECK_BLOCKS blocks. The last
+## instructions before a budget runs out are executed one at a time, so a
+## run stops exactly at the budget. So are the blocks of code that keeps
+## writing itself, which the block compiler leaves to the interpreter.
+##
+## With the interpreter (useBlocks=False) and the same cost for every
+## opcode, Machine.run runs in slices up to the next budget or clock check
+## (every TIME_CHECK_STEPS instructions). With different costs the cycles
+## are counted and the budgets checked on every instruction.
+##
+## A run ends with one of the statuses batch.py reports: "halted",
+## "max_steps", "max_cycles", "timeout" or "fault".
+##
+## usage: watchdog.py [--max-steps N] [--max-cycles N] [--timeout S]
+##                    [--cost NAME=N ...] [--interpreter] <programfile>
+##
+## e.g. --cost PRINT=20 --cost READ=20 makes I/O expensive. The report is
+## written to stderr after the program's output.
+
+
+TIME_CHECK_BLOCKS = 256
+TIME_CHECK_STEPS = 10000
+DEFAULT_COST = 1
+
+
+# Cycle cost of every opcode as a list indexed by the opcode.
+# costs maps opcode names (as the assembler spells them) to cycles.
+def cycleCosts(costs=None):
+    table = [DEFAULT_COST] * 64
+    for name, cost in (costs or {}).items():
+        if name not in opCodeNumbers:
+            raise ValueError('unknown opcode %r' % name)
+        if cost < 1:
+            raise ValueError('the cost of %s must be at least 1 cycle' % name)
+        table[opCodeNumbers[name]] = cost
+    return table
+
+
+# How a guarded run ended. steps and cycles are the ones of this run.
+class RunReport:
+    __slots__ = ('status', 'steps', 'cycles', 'seconds', 'error')
+
+    def __init__(self, status, steps, cycles, seconds, error=None):
+        self.status = status
+        self.steps = steps
+        self.cycles = cycles
+        self.seconds = seconds
+        self.error = error
+
+    def __repr__(self):
+        text = '%s after %d instructions, %d cycles in %.3fs' % (self.status, self.steps, self.cycles, self.seconds)
+        if self.error is not None:
+            text = text + ' (%s)' % self.error
+        return text
+
+
+# Execute single instructions like Machine.run, counting their cycles.
+# Stops at HALT, when a budget is used up, at the deadline or after
+# limit instructions. Returns the status (None after limit instructions)
+# and the cycles executed.
+def stepRun(machine, costs, maxSteps, maxCycles, deadline, limit=None):
+    decoded = machine.decoded
+    steps = 0
+    cycles = 0
+    countdown = TIME_CHECK_STEPS
+    try:
+        while steps != limit:
+            if steps == maxSteps:
+                return 'max_steps', cycles
+            if deadline is not None:
+                countdown = countdown - 1
+                if countdown == 0:
+                    countdown = TIME_CHECK_STEPS
+                    if time.perf_counter() > deadline:
+                        return 'timeout', cycles
+            program_counter = machine.program_counter
+            try:
+                instruction = decoded[program_counter]
+            except KeyError:
+                instruction = machine.decodeAt(program_counter)
+            opcode, modeInt, operandInt = instruction
+            cost = costs[opcode]
+            if maxCycles is not None and cycles + cost > maxCycles:
+                return 'max_cycles', cycles
+            steps = steps + 1
+            cycles = cycles + cost
+            # HALT
+            if opcode == 0x01:
+                machine.halted = True
+                machine.output.flush()
+                return 'halted', cycles
+            if handlers[opcode](machine, modeInt, operandInt):
+                continue
+            machine.program_counter = (program_counter + 3) & 0xFFFF
+    except Exception as error:
+        error.cycles = cycles
+        raise
+    finally:
+        machine.steps = machine.steps + steps
+    return None, cycles
+
+
+# The interpreter when every opcode costs the same: the cycles are the steps
+# times the cost, and Machine.run executes the slices between two checks.
+def sliceRun(machine, cost, maxSteps, maxCycles, deadline):
+    start = machine.steps
+    limit = maxSteps
+    if maxCycles is not None and (limit is None or maxCycles // cost < limit):
+        limit = maxCycles // cost
+    try:
+        while not machine.halted:
+            done = machine.steps - start
+            if done == limit:
+                return ('max_steps' if done == maxSteps else 'max_cycles'), done * cost
+            budget = None if limit is None else limit - done
+            if deadline is not None:
+                budget = TIME_CHECK_STEPS if budget is None else min(budget, TIME_CHECK_STEPS)
+            machine.run(budget)
+            if deadline is not None and not machine.halted and time.perf_counter() > deadline:
+                return 'timeout', (machine.steps - start) * cost
+    except Exception as error:
+        error.cycles = (machine.steps - start) * cost
+        raise
+    return 'halted', (machine.steps - start) * cost
+
+
+# The compiled block loop of runGuarded().
+def blockRun(machine, costs, maxSteps, maxCycles, deadline):
+    blocks = machine.blocks
+    start = machine.steps
+    stepLimit = float('inf') if maxSteps is None else start + maxSteps
+    cycleLimit = float('inf') if maxCycles is None else maxCycles
+    cycles = 0
+    countdown = TIME_CHECK_BLOCKS
+    while not machine.halted:
+        if deadline is not None:
+            countdown = countdown - 1
+            if countdown == 0:
+                countdown = TIME_CHECK_BLOCKS
+                if time.perf_counter() > deadline:
+                    return 'timeout', cycles
+        address = machine.program_counter
+        block = blocks.get(address)
+        if block is None:
+            block = compileBlock(machine, address)
+        # Cycles of the first n instructions of the block, kept on the block
+        # with the cost table they were summed up for.
+        if getattr(block, 'costs', None) is not costs:
+            block.prefix = [0]
+            for opcode in block.opcodes:
+                block.prefix.append(block.prefix[-1] + costs[opcode])
+            block.costs = costs
+        prefix = block.prefix
+        if (block.interpreted or machine.steps + block.length > stepLimit or
+                cycles + prefix[-1] > cycleLimit):
+            # Close to a budget: one instruction at a time for the length of the block.
+            try:
+                status, executed = stepRun(machine, costs,
+                                           None if maxSteps is None else stepLimit - machine.steps,
+                                           None if maxCycles is None else cycleLimit - cycles,
+                                           None, block.length)
+            except Exception as error:
+                error.cycles = cycles + error.cycles
+                raise
+            cycles = cycles + executed
+            if status is not None:
+                return status, cycles
+            continue
+        before = machine.steps
+        if block.loop is not None:
+            # A tight loop runs as many whole iterations as the budgets allow.
+            budget = min(stepLimit - machine.steps, (cycleLimit - cycles) // prefix[-1] * block.length)
+            machine.program_counter = block(machine, None if budget == float('inf') else int(budget))
+            cycles = cycles + (machine.steps - before) // block.length * prefix[-1]
+            continue
+        try:
+            machine.program_counter = block(machine)
+        except Exception as error:
+            error.cycles = cycles + prefix[countFailedBlock(machine, address, before)]
+            raise
+        cycles = cycles + prefix[machine.steps - before]
+    return 'halted', cycles
+
+
+# Run the loaded machine until HALT, a fault or until a budget is used up.
+# maxSteps and maxCycles count from the start of this call, timeout is in
+# seconds of wall time. costs is a table from cycleCosts().
+# Returns a RunReport, faults of the program are reported and not raised.
+def runGuarded(machine, maxSteps=None, maxCycles=None, timeout=None, costs=None, useBlocks=True):
+    costs = cycleCosts() if costs is None else costs
+    begin = time.perf_counter()
+    deadline = None if timeout is None else begin + timeout
+    start = machine.steps
+    if machine.halted:
+        return RunReport('halted', 0, 0, 0.0)
+    try:
+        if useBlocks:
+            status, cycles = blockRun(machine, costs, maxSteps, maxCycles, deadline)
+        elif min(costs) == max(costs):
+            status, cycles = sliceRun(machine, costs[0], maxSteps, maxCycles, deadline)
+        else:
+            status, cycles = stepRun(machine, costs, maxSteps, maxCycles, deadline)
+    except Exception as error:
+        return RunReport('fault', machine.steps - start, getattr(error, 'cycles', 0),
+                         time.perf_counter() - begin, '%s: %s' % (type(error).__name__, error))
+    return RunReport(status, machine.steps - start, cycles, time.perf_counter() - begin)
+
+
+def main(argv):
+    maxSteps = maxCycles = timeout = None
+    costs = {}
+    useBlocks = True
+    arguments = argv[1:]
+    try:
+        while len(arguments) > 1:
+            if arguments[0] == '--max-steps':
+                maxSteps = int(arguments[1])
+            elif arguments[0] == '--max-cycles':
+                maxCycles = int(arguments[1])
+            elif arguments[0] == '--timeout':
+                timeout = float(arguments[1])
+            elif arguments[0] == '--cost':
+                name, cost = arguments[1].split('=')
+                costs[name] = int(cost)
+            elif arguments[0] == '--interpreter':
+                useBlocks = False
+                arguments = arguments[1:]
+                continue
+            else:
+                break
+            arguments = arguments[2:]
+        costTable = cycleCosts(costs)
+    except ValueError as error:
+        print(error); arguments = []
+    if len(arguments) != 1:
+        print('usage: watchdog.py [--max-steps N] [--max-cycles N] [--timeout S] [--cost NAME=N ...] '
+              '[--interpreter] <programfile>'); sys.exit(1)
+    machine = Machine()
+    machine.loadFile(arguments[0])
+    try:
+        report = runGuarded(machine, maxSteps, maxCycles, timeout, costTable, useBlocks)
+    finally:
+        machine.output.flush()
+    sys.stderr.write('%r\n' % (report,))
+    sys.exit(0 if report.status == 'halted' else 2)
+
+
+if __name__ == '__main__':
+    main(sys.argv)